@@ -1,26 +1,45 @@
 # app.py
 
 from db.models import db
+from db.db_init import engine_options, replica_binds
+from db.routing import init_replica_routing
 from resources.resources import api as books_api
-from db.models import BookType
+from utils.metrics import init_metrics
+from utils.request_log import init_logging
 
 from flask import Flask
 from flask_restx import Api, reqparse
 
-import logging
 import os
 
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", "sqlite://books.db")
-db.init_app(app)
-api = Api(app, doc="/swagger/")
-api.add_namespace(books_api, path="/books")
+def create_app():
+    """
+    Build the application from environment variables.
+
+    Nothing here touches the database: the engine connects on the first
+    request, and the schema and the default book types are created by the
+    one-shot `python -m db.migrations` command, not by serving processes.
+    """
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv(
+        "DATABASE_URL", "sqlite://books.db"
+    )
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config["SQLALCHEMY_DATABASE_URI"]
+    )
+    # Optional read replicas, GET requests are spread over them
+    app.config["SQLALCHEMY_BINDS"] = replica_binds(os.getenv("DATABASE_REPLICA_URLS"))
+    db.init_app(app)
+    init_replica_routing(app)
+    api = Api(app, doc="/swagger/")
+    api.add_namespace(books_api, path="/books")
+    init_metrics(app)
+
+    # Structured JSON logs, written by a background thread
+    init_logging(app)
+    return app
 
-# Configure Flask logging
-app.logger.setLevel(logging.INFO)  # Set log level to INFO
-handler = logging.FileHandler("app.log")  # Log to a file
-app.logger.addHandler(handler)
 
 parser = reqparse.RequestParser()
 parser.add_argument(
@@ -40,10 +59,4 @@ parser.add_argument(
 
 
 if __name__ == "__main__":
-    with app.app_context():
-        db.create_all()
-        if len(db.session.query(BookType).all()) == 0:
-            db.session.add(BookType(name="fiction"))
-            db.session.add(BookType(name="non-fiction"))
-            db.session.commit()
-    app.run(debug=os.getenv("FLASK_DEBUG"), host="0.0.0.0", port=5000)
+    create_app().run(debug=os.getenv("FLASK_DEBUG"), host="0.0.0.0", port=5000)
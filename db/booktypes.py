@@ -0,0 +1,79 @@
+# booktypes.py
+
+import threading
+
+from sqlalchemy import event, insert, select
+
+from .db_init import db
+from .models import BookType
+
+
+# Types every database starts with, see seed_book_types
+DEFAULT_BOOK_TYPES = ["fiction", "non-fiction"]
+
+
+class BookTypeRegistry:
+    """
+    In-process cache of the booktypes table as name <-> id maps.
+
+    The table is read once on first use and again only after a BookType row
+    is inserted, updated or deleted through the ORM, so validation, writes
+    and filters can resolve types without touching the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_name = None
+        self._by_id = None
+
+    def _maps(self):
+        by_name, by_id = self._by_name, self._by_id
+        if by_name is None:
+            with self._lock:
+                if self._by_name is None:
+                    rows = db.session.query(BookType.id, BookType.name).all()
+                    self._by_id = {type_id: name for type_id, name in rows}
+                    self._by_name = {name: type_id for type_id, name in rows}
+                by_name, by_id = self._by_name, self._by_id
+        return by_name, by_id
+
+    def names(self):
+        return sorted(self._maps()[0])
+
+    def id_for(self, name):
+        """Return the id of the type called `name`, or None if it doesn't exist."""
+        return self._maps()[0].get(name)
+
+    def name_for(self, type_id):
+        """Return the name of the type with `type_id`, or None if it doesn't exist."""
+        return self._maps()[1].get(type_id)
+
+    def invalid_type_message(self):
+        return "Type must be " + " or ".join(f'"{name}"' for name in self.names())
+
+    def invalidate(self):
+        with self._lock:
+            self._by_name = None
+            self._by_id = None
+
+
+booktypes = BookTypeRegistry()
+
+
+@event.listens_for(BookType, "after_insert")
+@event.listens_for(BookType, "after_update")
+@event.listens_for(BookType, "after_delete")
+def _invalidate_booktypes(mapper, connection, target):
+    booktypes.invalidate()
+
+
+def seed_book_types(connection):
+    """
+    Insert the DEFAULT_BOOK_TYPES that don't exist yet and return their
+    names. Running it again changes nothing.
+    """
+    existing = set(connection.execute(select(BookType.name)).scalars())
+    missing = [name for name in DEFAULT_BOOK_TYPES if name not in existing]
+    if missing:
+        connection.execute(insert(BookType), [{"name": name} for name in missing])
+    return missing
@@ -1,11 +1,60 @@
 # db_init.py
 
+import os
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import DeclarativeBase
 
+from db.routing import REPLICA_BIND_PREFIX, RoutingSession
+
 
 class Base(DeclarativeBase):
     pass
 
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={"class_": RoutingSession})
+
+
+def engine_options(database_url):
+    """
+    Engine options for `database_url` from DB_* environment variables.
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW: connections kept open / opened on top
+    DB_POOL_TIMEOUT: seconds to wait for a free connection before failing
+    DB_POOL_RECYCLE: seconds after which a connection is replaced
+    DB_POOL_PRE_PING: 1 to test connections before handing them out
+    DB_STATEMENT_TIMEOUT: milliseconds a statement may run (Postgres only)
+    """
+    url = make_url(database_url)
+    options = {"pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1"}
+
+    # In-memory SQLite uses a single connection, there is no pool to size
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return options
+
+    options.update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "5")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    )
+
+    statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT", "0"))
+    if url.get_backend_name() == "postgresql" and statement_timeout:
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={statement_timeout}"
+        }
+    return options
+
+
+def replica_binds(replica_urls):
+    """
+    SQLALCHEMY_BINDS entries for a comma separated list of read replica URLs,
+    each with the same pool settings as the primary.
+    """
+    urls = [url.strip() for url in (replica_urls or "").split(",") if url.strip()]
+    return {
+        f"{REPLICA_BIND_PREFIX}{i}": {"url": url, **engine_options(url)}
+        for i, url in enumerate(urls)
+    }
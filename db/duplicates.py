@@ -0,0 +1,310 @@
+# duplicates.py
+#
+# Near-duplicate books: the same source added again with small spelling
+# differences. Candidates are found through an index, never by comparing a
+# book with every other one, and then scored in Python:
+#
+#   Postgres: trigram similarity of the title (pg_trgm, GIN index)
+#   other databases: blocking keys, the title and the author without case,
+#       vowels, spaces and punctuation, cut to a prefix; every key has an
+#       expression index, so a lookup is an index probe
+#
+# The duplicates report groups all books by their title key and only scores
+# neighbours inside a group.
+
+import os
+import re
+import string
+import unicodedata
+from difflib import SequenceMatcher
+
+from sqlalchemy import Integer, String, and_, column, func, literal, literal_column
+from sqlalchemy import select, text, true, union_all, values
+from sqlalchemy.orm import aliased
+
+from .models import Book
+
+
+# Books scoring at least this much against each other are reported
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.85"))
+
+# Dropped from the blocking keys: vowels, spaces and punctuation, the
+# characters most typos and formatting differences are made of
+_DROPPED = "aeiouy .,:;-_'\"!?()[]&/"
+TITLE_KEY_LENGTH = 10
+AUTHOR_KEY_LENGTH = 8
+
+# Rows fetched per key lookup, and books compared with each book of a report
+# group (sorted neighbourhood)
+MAX_CANDIDATES = 50
+REPORT_WINDOW = 20
+
+# Capped key lookups per statement on databases without trigram indexes, a
+# looked up book takes up to three
+KEY_LOOKUPS_PER_STATEMENT = 250
+
+
+def _key_sql(column_name, length):
+    expression = f"lower({column_name})"
+    for char in _DROPPED:
+        quoted = char.replace("'", "''")
+        expression = f"replace({expression}, '{quoted}', '')"
+    return f"substr({expression}, 1, {length})"
+
+
+# The query has to repeat the exact indexed expression for the index to be used
+TITLE_KEY = literal_column(_key_sql("books.title", TITLE_KEY_LENGTH), String)
+AUTHOR_KEY = literal_column(_key_sql("books.author", AUTHOR_KEY_LENGTH), String)
+
+KEY_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_books_title_key ON books "
+    f"({_key_sql('title', TITLE_KEY_LENGTH)})",
+    "CREATE INDEX IF NOT EXISTS ix_books_author_key ON books "
+    f"({_key_sql('author', AUTHOR_KEY_LENGTH)})",
+]
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_books_title_trgm ON books "
+    "USING GIN (lower(title) gin_trgm_ops)",
+    # The report still groups by the title key
+    KEY_DDL[0],
+]
+
+
+def create_duplicate_indexes(connection):
+    """Create the indexes the duplicate lookups use on the connected database."""
+    if connection.dialect.name == "postgresql":
+        statements = POSTGRES_DDL
+    else:
+        statements = KEY_DDL
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_DROP = str.maketrans("", "", _DROPPED)
+
+
+def blocking_key(value, length):
+    """
+    The key _key_sql() computes in the database: SQLite's lower() only
+    changes ASCII letters, so this does too.
+    """
+    return value.translate(_ASCII_LOWER).translate(_DROP)[:length]
+
+
+def normalize(value):
+    """Lowercase words without accents or punctuation, for scoring."""
+    value = unicodedata.normalize("NFKD", value)
+    value = "".join(char for char in value if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", value.lower()))
+
+
+def _ratio(a, b):
+    return SequenceMatcher(None, a, b).ratio()
+
+
+def similarity(a, b):
+    """
+    Score two (title, author) pairs from 0 to 1. Authors also match with
+    their names in another order, "Cormen, Thomas" and "Thomas Cormen".
+    """
+    title = _ratio(normalize(a[0]), normalize(b[0]))
+    author_a, author_b = normalize(a[1]), normalize(b[1])
+    author = max(
+        _ratio(author_a, author_b),
+        _ratio(" ".join(sorted(author_a.split())), " ".join(sorted(author_b.split()))),
+    )
+    return round(0.7 * title + 0.3 * author, 3)
+
+
+def _trigram_candidates(session, books):
+    # Every looked up book probes the trigram index once, in one statement
+    looked_up = values(
+        column("number", Integer),
+        column("title", String),
+        name="looked_up",
+    ).data([(number, book["title"]) for number, book in enumerate(books)])
+    title = func.lower(Book.title)
+    match = (
+        select(Book)
+        .where(title.bool_op("%")(func.lower(looked_up.c.title)))
+        .order_by(func.similarity(title, func.lower(looked_up.c.title)).desc())
+        .limit(MAX_CANDIDATES)
+        .lateral("match")
+    )
+    matched_book = aliased(Book, match)
+    rows = session.execute(
+        select(looked_up.c.number, matched_book)
+        .select_from(looked_up)
+        .join(match, true())
+    )
+    candidates = [[] for _ in books]
+    for number, book in rows:
+        candidates[number].append(book)
+    return candidates
+
+
+def _capped(number, rank, condition):
+    # Unsorted, so the index probe stops after MAX_CANDIDATES rows
+    return select(
+        select(
+            literal(number).label("number"),
+            literal(rank).label("rank"),
+            *Book.__table__.c,
+        )
+        .where(condition)
+        .limit(MAX_CANDIDATES)
+        .subquery()
+    )
+
+
+def _key_lookups(number, book):
+    # The rows of one looked up book, capped on their own so a crowded key
+    # can't crowd out the other books: the rows matching both keys first,
+    # then the rows matching either key
+    title_key = blocking_key(book["title"], TITLE_KEY_LENGTH)
+    author_key = blocking_key(book["author"], AUTHOR_KEY_LENGTH)
+    # A key of nothing but dropped characters would match too much
+    conditions = []
+    if title_key:
+        conditions.append(TITLE_KEY == title_key)
+    if author_key:
+        conditions.append(AUTHOR_KEY == author_key)
+    lookups = [_capped(number, 1, condition) for condition in conditions]
+    if len(conditions) == 2:
+        lookups.insert(0, _capped(number, 0, and_(*conditions)))
+    return lookups
+
+
+def _key_candidates(session, books):
+    lookups = []
+    for number, book in enumerate(books):
+        lookups += _key_lookups(number, book)
+    found = [{} for _ in books]
+    # SQLite allows at most 500 SELECTs in one UNION
+    for start in range(0, len(lookups), KEY_LOOKUPS_PER_STATEMENT):
+        matches = union_all(*lookups[start : start + KEY_LOOKUPS_PER_STATEMENT])
+        matches = matches.subquery()
+        matched_book = aliased(Book, matches)
+        rows = session.execute(
+            select(matches.c.number, matches.c.rank, matched_book).order_by(
+                matches.c.number, matches.c.rank
+            )
+        )
+        for number, rank, book in rows:
+            found[number].setdefault(book.id, book)
+    return [list(books.values()) for books in found]
+
+
+def find_duplicates(session, books, limit=5):
+    """
+    Look up the existing books that are near duplicates of every book in
+    `books`, dicts with a title and an author, with one statement (per
+    KEY_LOOKUPS_PER_STATEMENT key lookups without trigram indexes).
+
+    Returns a list with, for every book, up to `limit` (Book, score) pairs
+    scoring at least DUPLICATE_THRESHOLD, best first.
+    """
+    if not books:
+        return []
+    if session.get_bind().dialect.name == "postgresql":
+        candidates = _trigram_candidates(session, books)
+    else:
+        candidates = _key_candidates(session, books)
+
+    duplicates = []
+    for book, found in zip(books, candidates):
+        scored = []
+        for candidate in found:
+            score = similarity(
+                (book["title"], book["author"]), (candidate.title, candidate.author)
+            )
+            if score >= DUPLICATE_THRESHOLD:
+                scored.append((candidate, score))
+        scored.sort(key=lambda pair: (-pair[1], pair[0].id))
+        duplicates.append(scored[:limit])
+    return duplicates
+
+
+def earlier_duplicates(books):
+    """
+    For every book of `books` (dicts with a title and an author), the index
+    of an earlier book of the list it nearly duplicates, or None.
+    """
+    earlier = [None] * len(books)
+    seen = {}
+    for row, book in enumerate(books):
+        pair = (book["title"], book["author"])
+        key = blocking_key(normalize(book["title"]), TITLE_KEY_LENGTH)
+        for other in seen.get(key, []):
+            other_pair = (books[other]["title"], books[other]["author"])
+            if similarity(pair, other_pair) >= DUPLICATE_THRESHOLD:
+                earlier[row] = other
+                break
+        seen.setdefault(key, []).append(row)
+    return earlier
+
+
+def _groups(books):
+    # Union-find over the near-duplicate pairs among sorted neighbours
+    books = sorted(books, key=lambda book: (normalize(book.title), book.id))
+    parent = list(range(len(books)))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, book in enumerate(books):
+        for j in range(i + 1, min(i + 1 + REPORT_WINDOW, len(books))):
+            other = books[j]
+            if (
+                similarity((book.title, book.author), (other.title, other.author))
+                >= DUPLICATE_THRESHOLD
+            ):
+                parent[root(j)] = root(i)
+
+    groups = {}
+    for i, book in enumerate(books):
+        groups.setdefault(root(i), []).append(book)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def duplicate_groups(session, limit, after=None):
+    """
+    Find groups of near-duplicate books among the next `limit` title keys
+    shared by several books, after the key `after`.
+
+    Returns (groups, next key or None when there are no more keys), every
+    group is a list of books sorted by title.
+    """
+    keys = (
+        select(TITLE_KEY)
+        .select_from(Book)
+        .where(TITLE_KEY != "")
+        .group_by(TITLE_KEY)
+        .having(func.count() > 1)
+        .order_by(TITLE_KEY)
+        .limit(limit)
+    )
+    if after is not None:
+        keys = keys.where(TITLE_KEY > after)
+    rows = (
+        session.query(Book, TITLE_KEY)
+        .filter(TITLE_KEY.in_(keys.scalar_subquery()))
+        .order_by(TITLE_KEY)
+    )
+
+    blocks = {}
+    for book, key in rows:
+        blocks.setdefault(key, []).append(book)
+    groups = []
+    for key in blocks:
+        groups += _groups(blocks[key])
+    # The rows arrive in the database's collation order, which the next page
+    # filters by; Python's string order may differ from it
+    next_key = list(blocks)[-1] if len(blocks) == limit else None
+    return groups, next_key
@@ -0,0 +1,98 @@
+# membership.py
+#
+# Set-based changes of collection membership. They run straight against
+# bookcollection_book instead of loading Book rows and letting the ORM diff
+# the whole `BookCollection.books` list.
+
+from sqlalchemy import and_, delete, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .db_init import db
+from .models import Book, BookCollection, bookcollection_book_table
+from .versions import bump_table_version
+
+
+def _insert_ignoring_duplicates(rows):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(bookcollection_book_table)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(bookcollection_book_table)
+    else:
+        # Rows were filtered against the current membership already
+        return db.session.execute(insert(bookcollection_book_table), rows)
+    # A concurrent request may have added the same book meanwhile
+    return db.session.execute(statement.on_conflict_do_nothing(), rows)
+
+
+def touch_collection(collection_id):
+    """
+    Bump the version of a collection and the collections table after a
+    membership change. Returns False if the collection doesn't exist.
+    """
+    result = db.session.execute(
+        update(BookCollection)
+        .where(BookCollection.id == collection_id)
+        .values(version=BookCollection.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        return False
+    bump_table_version(db.session.connection(), "bookcollections")
+    return True
+
+
+def add_books(collection_id, book_ids):
+    """
+    Add books to a collection. Returns (added ids, missing ids); nothing is
+    added if any of the books doesn't exist. Existence and current
+    membership are checked together in one query.
+    """
+    book_ids = set(book_ids)
+    if not book_ids:
+        return [], []
+    rows = db.session.execute(
+        select(Book.id, bookcollection_book_table.c.book_id)
+        .outerjoin(
+            bookcollection_book_table,
+            and_(
+                bookcollection_book_table.c.book_id == Book.id,
+                bookcollection_book_table.c.bookcollection_id == collection_id,
+            ),
+        )
+        .where(Book.id.in_(book_ids))
+    ).all()
+    missing = sorted(book_ids - {book_id for book_id, _ in rows})
+    if missing:
+        return [], missing
+
+    added = sorted(book_id for book_id, member in rows if member is None)
+    if added:
+        _insert_ignoring_duplicates(
+            [
+                {"bookcollection_id": collection_id, "book_id": book_id}
+                for book_id in added
+            ]
+        )
+    return added, []
+
+
+def remove_books(collection_id, book_ids=None, keep=None):
+    """
+    Remove `book_ids` from a collection, or every book not in `keep`.
+    Returns the number of removed books.
+    """
+    statement = delete(bookcollection_book_table).where(
+        bookcollection_book_table.c.bookcollection_id == collection_id
+    )
+    if book_ids is not None:
+        if not book_ids:
+            return 0
+        statement = statement.where(
+            bookcollection_book_table.c.book_id.in_(set(book_ids))
+        )
+    if keep is not None:
+        statement = statement.where(
+            bookcollection_book_table.c.book_id.not_in(set(keep))
+        )
+    return db.session.execute(statement).rowcount
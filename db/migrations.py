@@ -0,0 +1,144 @@
+# migrations.py
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import func, insert, inspect, select, text
+
+from .booktypes import seed_book_types
+from .db_init import db
+from .duplicates import create_duplicate_indexes
+from .models import Book, BookCollection, BookType, TableVersion
+from .models import bookcollection_book_table
+from .search import create_search_indexes
+from .stats import create_stats_tables
+
+
+# Kept out of db.metadata so db.create_all() never touches it
+migration_metadata = MetaData()
+
+schema_version_table = Table(
+    "schema_version",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, server_default=func.now()),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a schema change. Versions are applied in ascending order."""
+
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return upgrade
+
+    return register
+
+
+@migration(1, "Initial schema")
+def _initial_schema(connection):
+    # Databases created by db.create_all() before migrations existed already
+    # have these tables, create_all skips them
+    db.metadata.create_all(
+        connection,
+        tables=[
+            BookType.__table__,
+            Book.__table__,
+            BookCollection.__table__,
+            bookcollection_book_table,
+        ],
+    )
+
+
+@migration(2, "Secondary indexes on books and bookcollection_book")
+def _book_indexes(connection):
+    for table in (Book.__table__, bookcollection_book_table):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+@migration(3, "Full-text search indexes on books and bookcollections")
+def _search_indexes(connection):
+    create_search_indexes(connection)
+
+
+@migration(4, "Row versions and table versions for ETags")
+def _versions(connection):
+    for table in ("books", "bookcollections"):
+        columns = {column["name"] for column in inspect(connection).get_columns(table)}
+        if "version" not in columns:
+            connection.execute(
+                text(
+                    f"ALTER TABLE {table} "
+                    "ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+                )
+            )
+    TableVersion.__table__.create(connection, checkfirst=True)
+    existing = set(connection.execute(select(TableVersion.name)).scalars())
+    for name in sorted({"books", "bookcollections"} - existing):
+        connection.execute(insert(TableVersion.__table__).values(name=name, version=1))
+
+
+@migration(5, "Summary tables of book counts for statistics")
+def _stats_tables(connection):
+    create_stats_tables(connection)
+
+
+@migration(6, "Indexes for near-duplicate book lookups")
+def _duplicate_indexes(connection):
+    create_duplicate_indexes(connection)
+
+
+def current_version(connection):
+    schema_version_table.create(connection, checkfirst=True)
+    version = connection.execute(
+        select(func.max(schema_version_table.c.version))
+    ).scalar()
+    return version or 0
+
+
+def upgrade(engine):
+    """
+    Apply every migration newer than the version recorded in the database.
+    Each migration runs in its own transaction. Returns the applied versions.
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+
+    applied = []
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        with engine.begin() as connection:
+            apply(connection)
+            connection.execute(
+                insert(schema_version_table).values(
+                    version=number, description=description
+                )
+            )
+        applied.append(number)
+    return applied
+
+
+def initialize(engine):
+    """
+    Bring a database up to date: apply pending migrations and seed the
+    default book types. Returns (applied versions, seeded type names).
+    """
+    applied = upgrade(engine)
+    with engine.begin() as connection:
+        seeded = seed_book_types(connection)
+    return applied, seeded
+
+
+if __name__ == "__main__":
+    # python -m db.migrations, run once per deploy before starting the server
+    from app import create_app
+
+    with create_app().app_context():
+        applied, seeded = initialize(db.engine)
+    print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+    if seeded:
+        print(f"Seeded book types: {seeded}")
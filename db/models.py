@@ -5,7 +5,7 @@ from typing import List
 
 from .db_init import db
 
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, Index
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 
@@ -22,13 +22,16 @@ class BookType(db.Model):
 
 class Book(db.Model):
     __tablename__ = "books"
+    __table_args__ = (Index("ix_books_type_id_year", "type_id", "year"),)
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    title: Mapped[str] = mapped_column(nullable=False)
-    author: Mapped[str] = mapped_column(nullable=False)
+    title: Mapped[str] = mapped_column(nullable=False, index=True)
+    author: Mapped[str] = mapped_column(nullable=False, index=True)
     type_id: Mapped[int] = mapped_column(ForeignKey("booktypes.id"))
     type: Mapped["BookType"] = relationship(back_populates="books")
-    year: Mapped[int] = mapped_column(nullable=False)
+    year: Mapped[int] = mapped_column(nullable=False, index=True)
+    # Incremented on every change, see db/versions.py
+    version: Mapped[int] = mapped_column(nullable=False, default=1, server_default="1")
 
 
 bookcollection_book_table = db.Table(
@@ -36,6 +39,8 @@ bookcollection_book_table = db.Table(
     db.metadata,
     Column("bookcollection_id", ForeignKey("bookcollections.id"), primary_key=True),
     Column("book_id", ForeignKey("books.id"), primary_key=True),
+    # The primary key covers lookups by collection, this one covers lookups by book
+    Index("ix_bookcollection_book_book_id", "book_id"),
 )
 
 
@@ -46,3 +51,14 @@ class BookCollection(db.Model):
     name: Mapped[str] = mapped_column()
     description: Mapped[str] = mapped_column(nullable=True)
     books: Mapped[list["Book"]] = relationship(secondary=bookcollection_book_table)
+    # Incremented on every change, including membership, see db/versions.py
+    version: Mapped[int] = mapped_column(nullable=False, default=1, server_default="1")
+
+
+class TableVersion(db.Model):
+    """Counter per table, incremented whenever any of its rows change."""
+
+    __tablename__ = "table_versions"
+
+    name: Mapped[str] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(nullable=False, default=1)
@@ -0,0 +1,93 @@
+# routing.py
+
+import functools
+import os
+import random
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+
+# Engines configured in SQLALCHEMY_BINDS under these keys serve reads
+REPLICA_BIND_PREFIX = "replica_"
+
+# After a write the client reads from the primary for this many seconds,
+# so it sees its own changes even if the replicas lag behind
+PRIMARY_COOKIE = "db_read_primary_until"
+STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+
+
+def read_only(method):
+    """Mark a resource method as safe to run on a read replica."""
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return method(*args, **kwargs)
+
+    return wrapper
+
+
+def pinned_to_primary():
+    """True if the client of the current request wrote recently, see PRIMARY_COOKIE."""
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) >= time.time()
+    except ValueError:
+        return False
+
+
+def _reads_from_replica(session):
+    if not has_request_context() or not g.get("db_read_only"):
+        return False
+    if session.info.get("wrote") or session._flushing:
+        return False
+    return not pinned_to_primary()
+
+
+class RoutingSession(Session):
+    """
+    Session that sends the statements of read-only resource methods to a
+    replica engine, picked at random once per request: the ETag version and
+    the body it describes are read from the same replica. Writes, anything
+    after a write in the same request and requests of clients that just
+    wrote stay on the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and _reads_from_replica(self):
+            replicas = [
+                engine
+                for key, engine in self._db.engines.items()
+                if key and key.startswith(REPLICA_BIND_PREFIX)
+            ]
+            if replicas:
+                if g.get("db_replica") not in replicas:
+                    g.db_replica = random.choice(replicas)
+                return g.db_replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _mark_written(session, flush_context):
+    session.info["wrote"] = True
+
+
+def init_replica_routing(app):
+    """Send clients that changed something to the primary for a while."""
+
+    @app.after_request
+    def stick_to_primary(response):
+        if (
+            request.method not in ("GET", "HEAD", "OPTIONS")
+            and not g.get("db_read_only")
+            and response.status_code < 400
+        ):
+            response.set_cookie(
+                PRIMARY_COOKIE,
+                str(time.time() + STICKY_SECONDS),
+                max_age=STICKY_SECONDS,
+                httponly=True,
+            )
+        return response
@@ -0,0 +1,171 @@
+# search.py
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table
+from sqlalchemy import and_, func, literal_column, or_, text
+
+from .models import Book, BookCollection
+
+
+# FTS5 tables only exist on SQLite and are maintained by triggers,
+# so they are kept out of db.metadata
+search_metadata = MetaData()
+
+books_fts_table = Table(
+    "books_fts",
+    search_metadata,
+    Column("rowid", Integer, key="rowid"),
+    Column("books_fts", String),
+    Column("rank", Float),
+)
+
+bookcollections_fts_table = Table(
+    "bookcollections_fts",
+    search_metadata,
+    Column("rowid", Integer, key="rowid"),
+    Column("bookcollections_fts", String),
+    Column("rank", Float),
+)
+
+# Postgres matches against GIN expression indexes on these documents, the
+# query has to repeat the exact expression for the index to be used
+_SPACE = literal_column("' '")
+_EMPTY = literal_column("''")
+BOOK_DOCUMENT = func.to_tsvector(
+    literal_column("'simple'"), Book.title + _SPACE + Book.author
+)
+COLLECTION_DOCUMENT = func.to_tsvector(
+    literal_column("'simple'"),
+    func.coalesce(BookCollection.name, _EMPTY)
+    + _SPACE
+    + func.coalesce(BookCollection.description, _EMPTY),
+)
+
+POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_books_fts ON books USING GIN "
+    "(to_tsvector('simple', title || ' ' || author))",
+    "CREATE INDEX IF NOT EXISTS ix_bookcollections_fts ON bookcollections "
+    "USING GIN (to_tsvector('simple', "
+    "coalesce(name, '') || ' ' || coalesce(description, '')))",
+]
+
+
+def _sqlite_fts_ddl(table, columns):
+    fts = f"{table}_fts"
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+    old_values = ", ".join(f"old.{column}" for column in columns)
+    delete_old = (
+        f"INSERT INTO {fts}({fts}, rowid, {column_list}) "
+        f"VALUES ('delete', old.id, {old_values});"
+    )
+    insert_new = (
+        f"INSERT INTO {fts}(rowid, {column_list}) VALUES (new.id, {new_values});"
+    )
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5"
+        f"({column_list}, content='{table}', content_rowid='id')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} "
+        f"BEGIN {insert_new} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} "
+        f"BEGIN {delete_old} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE ON {table} "
+        f"BEGIN {delete_old} {insert_new} END",
+        # Index the rows that existed before the table was created
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    ]
+
+
+SQLITE_DDL = _sqlite_fts_ddl("books", ["title", "author"]) + _sqlite_fts_ddl(
+    "bookcollections", ["name", "description"]
+)
+
+
+def create_search_indexes(connection):
+    """Create the full-text indexes for the connected database, if supported."""
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        statements = POSTGRES_DDL
+    elif dialect == "sqlite":
+        statements = SQLITE_DDL
+    else:
+        return
+    for statement in statements:
+        connection.execute(text(statement))
+
+
+def _fts5_query(q):
+    # Quote every word so user input can't break the FTS5 query syntax
+    return " ".join('"' + word.replace('"', '""') + '"' for word in q.split())
+
+
+def _dialect(query):
+    return query.session.get_bind().dialect.name
+
+
+def _search(query, q, model, fts_table, fts_column, document, columns):
+    dialect = _dialect(query)
+    if dialect == "postgresql":
+        return query.filter(
+            document.op("@@")(func.websearch_to_tsquery("simple", q))
+        )
+    if dialect == "sqlite":
+        return query.join(fts_table, fts_table.c.rowid == model.id).filter(
+            fts_table.c[fts_column].match(_fts5_query(q))
+        )
+    # No full-text support, every word has to appear in one of the columns
+    return query.filter(
+        and_(
+            *[
+                or_(*[column.ilike(f"%{word}%") for column in columns])
+                for word in q.split()
+            ]
+        )
+    )
+
+
+def _rank(query, q, fts_table, document):
+    dialect = _dialect(query)
+    if dialect == "postgresql":
+        return query.order_by(
+            func.ts_rank(document, func.websearch_to_tsquery("simple", q)).desc()
+        )
+    if dialect == "sqlite":
+        # FTS5 rank is bm25, lower is better
+        return query.order_by(fts_table.c.rank)
+    return query
+
+
+def search_books(query, q):
+    """Restrict a Book query to rows whose title or author match `q`."""
+    return _search(
+        query,
+        q,
+        Book,
+        books_fts_table,
+        "books_fts",
+        BOOK_DOCUMENT,
+        [Book.title, Book.author],
+    )
+
+
+def rank_books(query, q):
+    """Order a query already passed through search_books() by relevance."""
+    return _rank(query, q, books_fts_table, BOOK_DOCUMENT)
+
+
+def search_collections(query, q):
+    """Restrict a BookCollection query to rows whose name or description match `q`."""
+    return _search(
+        query,
+        q,
+        BookCollection,
+        bookcollections_fts_table,
+        "bookcollections_fts",
+        COLLECTION_DOCUMENT,
+        [BookCollection.name, BookCollection.description],
+    )
+
+
+def rank_collections(query, q):
+    """Order a query already passed through search_collections() by relevance."""
+    return _rank(query, q, bookcollections_fts_table, COLLECTION_DOCUMENT)
@@ -0,0 +1,249 @@
+# stats.py
+#
+# Book counts per year, type, author and collection, kept in summary tables
+# that database triggers update on every write. Reading the statistics then
+# costs one row per group instead of a scan of all books, whichever code path
+# (ORM, bulk import, membership statements, plain SQL) changed the data.
+
+from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy import cast, func, literal, literal_column, select, text, union_all
+
+from .models import Book, bookcollection_book_table
+
+
+# Maintained by triggers, so they are kept out of db.metadata
+stats_metadata = MetaData()
+
+books_by_year_table = Table(
+    "books_by_year",
+    stats_metadata,
+    Column("year", Integer, primary_key=True),
+    Column("count", Integer, nullable=False),
+)
+
+books_by_type_table = Table(
+    "books_by_type",
+    stats_metadata,
+    Column("type_id", Integer, primary_key=True),
+    Column("count", Integer, nullable=False),
+)
+
+books_by_author_table = Table(
+    "books_by_author",
+    stats_metadata,
+    Column("author", String, primary_key=True),
+    Column("count", Integer, nullable=False),
+)
+
+books_by_collection_table = Table(
+    "books_by_collection",
+    stats_metadata,
+    Column("bookcollection_id", Integer, primary_key=True),
+    Column("count", Integer, nullable=False),
+)
+
+# Summary table, the column it groups by and the table it counts rows of
+STATS_TABLES = [
+    (books_by_year_table, "year", "books"),
+    (books_by_type_table, "type_id", "books"),
+    (books_by_author_table, "author", "books"),
+    (books_by_collection_table, "bookcollection_id", "bookcollection_book"),
+]
+
+
+def _backfill(stats, key, source):
+    # Counts of the rows that existed before the triggers
+    return (
+        f"INSERT INTO {stats} ({key}, count) SELECT {key}, COUNT(*) FROM {source} "
+        f"WHERE {key} IS NOT NULL GROUP BY {key}"
+    )
+
+
+def _sqlite_ddl(stats, key, source):
+    increment = (
+        f"INSERT INTO {stats} ({key}, count) VALUES (new.{key}, 1) "
+        f"ON CONFLICT ({key}) DO UPDATE SET count = count + 1;"
+    )
+    decrement = (
+        f"UPDATE {stats} SET count = count - 1 WHERE {key} = old.{key}; "
+        f"DELETE FROM {stats} WHERE {key} = old.{key} AND count <= 0;"
+    )
+    prefix = f"CREATE TRIGGER IF NOT EXISTS {stats}_{source}"
+    return [
+        f"{prefix}_insert AFTER INSERT ON {source} "
+        f"WHEN new.{key} IS NOT NULL BEGIN {increment} END",
+        f"{prefix}_delete AFTER DELETE ON {source} "
+        f"WHEN old.{key} IS NOT NULL BEGIN {decrement} END",
+        f"{prefix}_update_old AFTER UPDATE OF {key} ON {source} "
+        f"WHEN old.{key} IS NOT new.{key} AND old.{key} IS NOT NULL "
+        f"BEGIN {decrement} END",
+        f"{prefix}_update_new AFTER UPDATE OF {key} ON {source} "
+        f"WHEN old.{key} IS NOT new.{key} AND new.{key} IS NOT NULL "
+        f"BEGIN {increment} END",
+    ]
+
+
+def _postgres_ddl(stats, key, source):
+    # Statement level triggers with transition tables: a bulk insert of
+    # thousands of books updates every group once, not once per book
+    add = (
+        f"INSERT INTO {stats} ({key}, count) "
+        f"SELECT {key}, COUNT(*) FROM new_rows WHERE {key} IS NOT NULL "
+        f"GROUP BY {key} "
+        f"ON CONFLICT ({key}) DO UPDATE SET count = {stats}.count + excluded.count;"
+    )
+    subtract = (
+        f"UPDATE {stats} SET count = {stats}.count - removed.count "
+        f"FROM (SELECT {key}, COUNT(*) AS count FROM old_rows "
+        f"WHERE {key} IS NOT NULL GROUP BY {key}) AS removed "
+        f"WHERE {stats}.{key} = removed.{key}; "
+        f"DELETE FROM {stats} WHERE count <= 0 "
+        f"AND {key} IN (SELECT {key} FROM old_rows);"
+    )
+    statements = []
+    for event, body, tables in (
+        ("INSERT", add, "NEW TABLE AS new_rows"),
+        ("DELETE", subtract, "OLD TABLE AS old_rows"),
+        ("UPDATE", subtract + " " + add, "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+    ):
+        function = f"{stats}_{source}_{event.lower()}"
+        statements += [
+            f"CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$ "
+            f"BEGIN {body} RETURN NULL; END $$ LANGUAGE plpgsql",
+            f"DROP TRIGGER IF EXISTS {function} ON {source}",
+            f"CREATE TRIGGER {function} AFTER {event} ON {source} "
+            f"REFERENCING {tables} FOR EACH STATEMENT EXECUTE FUNCTION {function}()",
+        ]
+    return statements
+
+
+def create_stats_tables(connection):
+    """
+    Create the summary tables, fill them from the current data and install
+    the triggers that keep them up to date, on SQLite and Postgres. Other
+    databases get no tables, their statistics are computed on every read.
+    """
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        ddl = _postgres_ddl
+    elif dialect == "sqlite":
+        ddl = _sqlite_ddl
+    else:
+        return
+    for stats, key, source in STATS_TABLES:
+        stats.create(connection, checkfirst=True)
+        connection.execute(stats.delete())
+        connection.execute(text(_backfill(stats.name, key, source)))
+        for statement in ddl(stats.name, key, source):
+            connection.execute(text(statement))
+
+
+def _counts(session, stats, key, source_column, limit=None):
+    if session.get_bind().dialect.name in ("postgresql", "sqlite"):
+        column = stats.c[key]
+        query = select(column, stats.c.count).where(stats.c.count > 0)
+        count = stats.c.count
+    else:
+        column = source_column
+        count = func.count()
+        query = select(column, count).where(column.is_not(None)).group_by(column)
+    if limit is None:
+        query = query.order_by(column)
+    else:
+        query = query.order_by(count.desc(), column).limit(limit)
+    return session.execute(query).all()
+
+
+def books_per_year(session):
+    return _counts(session, books_by_year_table, "year", Book.year)
+
+
+def books_per_type(session):
+    return _counts(session, books_by_type_table, "type_id", Book.type_id)
+
+
+def books_per_author(session, limit):
+    """The `limit` authors with the most books."""
+    return _counts(session, books_by_author_table, "author", Book.author, limit)
+
+
+def books_per_collection(session, limit):
+    """The `limit` collections with the most books."""
+    return _counts(
+        session,
+        books_by_collection_table,
+        "bookcollection_id",
+        bookcollection_book_table.c.bookcollection_id,
+        limit,
+    )
+
+
+# Facets of a book search, see book_facets()
+FACETS = ["type", "year", "author"]
+
+
+def book_facets(session, query, names, year_bucket, top):
+    """
+    Count the books of `query` per type, per `year_bucket` years and for the
+    `top` authors with the most books, for the facets in `names`, with one
+    grouped statement. `query` None counts all books, from the summary tables
+    where there are any.
+
+    Returns {facet: [(value, count), ...]}, years are the first year of their
+    bucket.
+    """
+    if query is None and session.get_bind().dialect.name in ("postgresql", "sqlite"):
+        columns = {
+            "type": books_by_type_table.c.type_id,
+            "year": books_by_year_table.c.year,
+            "author": books_by_author_table.c.author,
+        }
+        count = {
+            "type": func.sum(books_by_type_table.c.count),
+            "year": func.sum(books_by_year_table.c.count),
+            "author": func.sum(books_by_author_table.c.count),
+        }
+    else:
+        # Referenced once per facet, the database scans the filtered books once
+        books = (
+            (query if query is not None else session.query(Book))
+            .with_entities(Book.type_id, Book.year, Book.author)
+            .order_by(None)
+            .cte("facet_books")
+        )
+        columns = {
+            "type": books.c.type_id,
+            "year": books.c.year,
+            "author": books.c.author,
+        }
+        count = {name: func.count() for name in FACETS}
+
+    # A literal, not a parameter, so the GROUP BY repeats the exact expression
+    bucket = literal_column(str(int(year_bucket)))
+    columns["year"] = columns["year"] - columns["year"] % bucket
+
+    parts = []
+    for name in names:
+        column = columns[name]
+        part = select(
+            literal(name).label("facet"),
+            cast(column, String).label("value"),
+            count[name].label("count"),
+        ).group_by(column)
+        if name == "author":
+            part = select(
+                part.order_by(count[name].desc(), column).limit(top).subquery()
+            )
+        parts.append(part)
+    if not parts:
+        return {}
+
+    facets = {name: [] for name in names}
+    for facet, value, number in session.execute(union_all(*parts)):
+        facets[facet].append((value if facet == "author" else int(value), number))
+    for name, counts in facets.items():
+        if name == "author":
+            counts.sort(key=lambda row: (-row[1], row[0]))
+        else:
+            counts.sort()
+    return facets
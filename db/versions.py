@@ -0,0 +1,54 @@
+# versions.py
+
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.orm import Session
+
+from .db_init import db
+from .models import Book, BookCollection, TableVersion
+
+
+# Models whose rows carry a version and whose table has a TableVersion counter
+VERSIONED_TABLES = {Book: "books", BookCollection: "bookcollections"}
+
+table_versions_table = TableVersion.__table__
+
+
+def bump_table_version(connection, name):
+    """Increment the counter of table `name`. Call after Core-level writes."""
+    result = connection.execute(
+        update(table_versions_table)
+        .where(table_versions_table.c.name == name)
+        .values(version=table_versions_table.c.version + 1)
+    )
+    if result.rowcount == 0:
+        connection.execute(insert(table_versions_table).values(name=name, version=2))
+
+
+def table_version(name):
+    """Current counter of table `name`, 0 if it was never written."""
+    version = db.session.execute(
+        select(TableVersion.version).where(TableVersion.name == name)
+    ).scalar()
+    return version or 0
+
+
+@event.listens_for(Session, "before_flush")
+def _bump_versions(session, flush_context, instances):
+    changed = set()
+    for obj in session.new:
+        if type(obj) in VERSIONED_TABLES:
+            changed.add(VERSIONED_TABLES[type(obj)])
+    for obj in session.dirty:
+        if type(obj) in VERSIONED_TABLES and session.is_modified(obj):
+            # Incremented in the UPDATE itself, so concurrent writers can't
+            # both read the same version and write the same next one
+            obj.version = type(obj).version + 1
+            changed.add(VERSIONED_TABLES[type(obj)])
+    for obj in session.deleted:
+        if type(obj) in VERSIONED_TABLES:
+            changed.add(VERSIONED_TABLES[type(obj)])
+
+    if changed:
+        connection = session.connection()
+        for name in sorted(changed):
+            bump_table_version(connection, name)
@@ -1,5 +1,23 @@
 # api.py
 from flask_restx import Namespace
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 
 api = Namespace("books", description="Book related operations")
+
+
+@api.errorhandler(PoolTimeoutError)
+def handle_pool_timeout(error):
+    """Fail fast with 503 when no pooled connection frees up in DB_POOL_TIMEOUT."""
+    api.logger.warning(f"Database connection pool exhausted! {error}")
+    return {"error": "Database is busy, try again later"}, 503, {"Retry-After": "1"}
+
+
+@api.errorhandler(OperationalError)
+def handle_operational_error(error):
+    # 57014 is Postgres cancelling a statement that hit DB_STATEMENT_TIMEOUT
+    if getattr(error.orig, "pgcode", None) == "57014":
+        api.logger.warning(f"Statement timed out! {error}")
+        return {"error": "Database is busy, try again later"}, 503, {"Retry-After": "1"}
+    raise error
@@ -2,29 +2,36 @@
 
 from flask_restx import Resource, fields
 from flask import request
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 from .api import api
 from db.models import db
 from db.models import Book as Bookdb
-from db.models import BookType as BookTypedb
-from utils.utils import is_integer
+from db.booktypes import booktypes
+from db.routing import read_only
+from db.versions import table_version
+from utils.conditional import etag_headers, make_etag, not_modified, query_signature
+from utils.serializers import compile_marshal
+from utils.utils import is_integer, validate_book
 
 
-# Define individual book model
+def book_type_name(book):
+    # Resolved from the type cache, reading book.type would lazy-load it per book
+    return booktypes.name_for(book.type_id) if type(book) == Bookdb else None
+
+
+# Define individual book model, shared by every endpoint that returns books
 book_model = api.model(
     "Book",
     {
         "id": fields.Integer,
         "title": fields.String,
         "author": fields.String,
-        "type": fields.String(
-            attribute=lambda book: book.type.name
-            if type(book) == Bookdb and book.type
-            else None
-        ),
+        "type": fields.String(attribute=book_type_name),
         "year": fields.Integer,
     },
 )
+serialize_book = compile_marshal(book_model)
 
 
 # TODO get fix
@@ -32,15 +39,23 @@ class Book(Resource):
     @api.doc(
         description="Retrieve a book based on query parameters. Can filter by id, author, title, year, and book_type."
     )
-    @api.marshal_with(book_model)
-    @api.response(200, "Success")
+    @api.response(200, "Success", book_model)
+    @api.response(304, "Not Modified")
     @api.response(400, "Validation Error")
     @api.response(404, "Book not found")
     @api.response(500, "Internal Server Error")
+    @read_only
     def get(self, book_id=None):
         if book_id:
             result = db.session.query(Bookdb).filter(Bookdb.id == book_id).first()
+            etag = make_etag("book", result.id, result.version) if result else None
         else:
+            # Unchanged table means an unchanged result, checked before querying
+            etag = make_etag("books", table_version("books"), query_signature())
+            cached = not_modified(etag)
+            if cached:
+                return cached
+
             # Start with a base query
             query = db.session.query(Bookdb)
 
@@ -64,13 +79,13 @@ class Book(Resource):
                     return {"error": "Year is too long"}, 400
                 if not is_integer(year):
                     return {"error": "Year is not an integer"}, 400
-                query = query.filter(db.Book.year == year)
+                query = query.filter(Bookdb.year == year)
 
             if "book_type" in request.args:
-                book_type = request.args["book_type"]
-                if book_type not in ["fiction", "non-fiction"]:
-                    return {"error": 'Type must be "fiction" or "non-fiction"'}, 400
-                query = query.filter(Bookdb.type.has(name=book_type))
+                type_id = booktypes.id_for(request.args["book_type"])
+                if type_id is None:
+                    return {"error": booktypes.invalid_type_message()}, 400
+                query = query.filter(Bookdb.type_id == type_id)
 
             result = query.all()
 
@@ -78,7 +93,10 @@ class Book(Resource):
         if not result:
             return {"error": "No books found"}, 404
 
-        return result, 200
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        return serialize_book(result), 200, etag_headers(etag)
 
     @api.doc(description="Update an existing book.")
     @api.expect(book_model, validate=True)
@@ -94,20 +112,9 @@ class Book(Resource):
             return {"error": "No JSON data provided"}, 400
 
         # Validate that the required fields are present in the JSON data and that they are correct
-        if "title" not in data:
-            return {"error": 'Missing "title" field in JSON data'}, 400
-        if "author" not in data:
-            return {"error": 'Missing "author" field in JSON data'}, 400
-        if "type" not in data:
-            return {"error": 'Missing "type" field in JSON data'}, 400
-        if data["type"] not in ["fiction", "non-fiction"]:
-            return {"error": 'Type must be "fiction" or "non-fiction"'}, 400
-        if "year" not in data:
-            return {"error": 'Missing "year" field in JSON data'}, 400
-        if not is_integer(data["year"]):
-            return {"error": "Year is not an integer"}, 400
-        if len(str(data["year"])) > 4:
-            return {"error": "Year is too long"}, 400
+        error = validate_book(data)
+        if error:
+            return {"error": error}, 400
 
         book = db.session.query(Bookdb).filter(Bookdb.id == book_id).first()
         if not book:
@@ -118,15 +125,12 @@ class Book(Resource):
             book.title = data.get("title")
             book.author = data.get("author")
             book.year = data.get("year")
-            booktype = (
-                db.session.query(BookTypedb)
-                .filter(BookTypedb.name == data.get("type"))
-                .first()
-            )
-            book.type_id = booktype.id
+            book.type_id = booktypes.id_for(data.get("type"))
             db.session.commit()
             put_id = book.id
             return book, 200
+        except PoolTimeoutError:
+            raise
         except Exception as e:
             api.logger.error(f"Failed to modify book with id {book_id}! {e}")
             return {"error": "Failed to modify book", "id": put_id}, 500
@@ -158,6 +162,8 @@ class Book(Resource):
             db.session.delete(book)
             db.session.commit()
             return {"message": f"Book with id {book_id} deleted successfully"}, 200
+        except PoolTimeoutError:
+            raise
         except Exception as e:
             api.logger.error(f"Failed to delete book with id {book_id}! {e}")
             return {"error": "Book wasn't deleted"}, 500
@@ -0,0 +1,113 @@
+# bookbatch.py
+
+from flask_restx import Resource, fields, reqparse
+from flask import request
+
+from .api import api
+from .book import book_model
+from db.models import db
+from db.models import Book as Bookdb
+from db.routing import read_only
+from db.versions import table_version
+from utils.conditional import etag_headers, make_etag, not_modified
+from utils.serializers import compile_marshal
+from utils.utils import is_integer
+
+
+# Most ids one request may ask for, and the largest id a database driver
+# can bind (64-bit signed)
+MAX_BATCH_IDS = 1000
+MAX_BOOK_ID = 2**63 - 1
+
+book_batch_model = api.model(
+    "BookBatch",
+    {
+        "books": fields.List(fields.Nested(book_model)),
+        "missing": fields.List(fields.Integer),
+    },
+)
+serialize_book_batch = compile_marshal(book_batch_model)
+
+batch_request_model = api.model(
+    "BookBatchRequest",
+    {"ids": fields.List(fields.Integer, required=True, description="Book IDs")},
+)
+
+batch_parser = reqparse.RequestParser()
+batch_parser.add_argument(
+    "ids", type=str, required=True, help="Comma separated book IDs, e.g. 1,2,3"
+)
+
+
+def is_book_id(value):
+    # JSON true would otherwise be id 1
+    if isinstance(value, bool) or not is_integer(value):
+        return False
+    return int(value) <= MAX_BOOK_ID
+
+
+def parse_ids(ids):
+    """Validate a list of ids, returning (ids without duplicates, error)."""
+    if not isinstance(ids, list) or not ids:
+        return None, "ids must be a non-empty list of book IDs"
+    if not all(is_book_id(book_id) for book_id in ids):
+        return None, "ids must be positive integers"
+    # Keep the first occurrence of every id, in the requested order
+    ids = list(dict.fromkeys(int(book_id) for book_id in ids))
+    if len(ids) > MAX_BATCH_IDS:
+        return None, f"At most {MAX_BATCH_IDS} ids can be requested at once"
+    return ids, None
+
+
+def fetch_books(ids):
+    """
+    Load the books with `ids` in one query. Returns the books in the order
+    of `ids` and the ids that don't exist.
+    """
+    found = {
+        book.id: book for book in db.session.query(Bookdb).filter(Bookdb.id.in_(ids))
+    }
+    books = [found[book_id] for book_id in ids if book_id in found]
+    missing = [book_id for book_id in ids if book_id not in found]
+    return books, missing
+
+
+class BookBatch(Resource):
+    @api.doc(
+        description="Retrieve many books by id in one request. \
+        Books are returned in the requested order, unknown ids are listed in missing."
+    )
+    @api.expect(batch_parser)
+    @api.response(200, "Success", book_batch_model)
+    @api.response(304, "Not Modified")
+    @api.response(400, "Validation Error")
+    @read_only
+    def get(self):
+        args = batch_parser.parse_args()
+        ids, error = parse_ids(
+            [book_id.strip() for book_id in args["ids"].split(",") if book_id.strip()]
+        )
+        if error:
+            return {"error": error}, 400
+
+        etag = make_etag("batch", table_version("books"), ids)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        books, missing = fetch_books(ids)
+        body = serialize_book_batch({"books": books, "missing": missing})
+        return body, 200, etag_headers(etag)
+
+    @api.doc(description="Retrieve many books by id, for id lists too long for a URL.")
+    @api.expect(batch_request_model, validate=True)
+    @api.response(200, "Success", book_batch_model)
+    @api.response(400, "Validation Error")
+    @read_only
+    def post(self):
+        ids, error = parse_ids(request.json.get("ids"))
+        if error:
+            return {"error": error}, 400
+
+        books, missing = fetch_books(ids)
+        return serialize_book_batch({"books": books, "missing": missing}), 200
@@ -2,11 +2,22 @@
 
 from flask_restx import Resource, fields, reqparse
 from flask import request
+from sqlalchemy import select
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 from .api import api
+from .book import serialize_book
 from db.models import db
 from db.models import Book as Bookdb
 from db.models import BookCollection as BookCollectiondb
+from db.models import bookcollection_book_table
+from db.membership import add_books, remove_books, touch_collection
+from db.routing import read_only
+from db.search import rank_collections, search_collections
+from db.versions import table_version
+from utils.conditional import etag_headers, make_etag, not_modified, query_signature
+from utils.pagination import TOTAL_MODES, default_total_mode, keyset_page
+from utils.pagination import offset_page
 
 
 # Define the book collection model
@@ -23,7 +34,18 @@ book_collection_model = api.model(
     },
 )
 
+membership_model = api.model(
+    "BookCollectionMembership",
+    {
+        "add": fields.List(fields.Integer, description="Book IDs to add"),
+        "remove": fields.List(fields.Integer, description="Book IDs to remove"),
+    },
+)
+
 collection_filter_parser = reqparse.RequestParser()
+collection_filter_parser.add_argument(
+    "q", type=str, help="Full-text search in collection name and description"
+)
 collection_filter_parser.add_argument(
     "name", type=str, help="Filter by collection name"
 )
@@ -34,6 +56,59 @@ collection_filter_parser.add_argument("page", type=int, default=1, help="Page nu
 collection_filter_parser.add_argument(
     "per_page", type=int, choices=[10, 20, 50], default=10, help="Collections per page"
 )
+collection_filter_parser.add_argument(
+    "total",
+    choices=TOTAL_MODES,
+    help="How total and pages are computed, defaults to PAGINATION_TOTAL",
+)
+collection_filter_parser.add_argument(
+    "after", type=str, help="Cursor returned as next_cursor by the previous page"
+)
+collection_filter_parser.add_argument(
+    "limit", type=int, help="Collections per page in cursor mode"
+)
+
+
+collection_parser = reqparse.RequestParser()
+collection_parser.add_argument(
+    "expand",
+    choices=["books"],
+    help="books: return the full book objects inline, not only their ids",
+)
+
+
+def collection_book_ids(collection_ids):
+    """
+    Map every collection id to the ids of its books with a single query on
+    the association table, without loading any Book rows.
+    """
+    book_ids = {collection_id: [] for collection_id in collection_ids}
+    if not book_ids:
+        return book_ids
+    rows = db.session.execute(
+        select(
+            bookcollection_book_table.c.bookcollection_id,
+            bookcollection_book_table.c.book_id,
+        )
+        .where(bookcollection_book_table.c.bookcollection_id.in_(book_ids))
+        .order_by(bookcollection_book_table.c.book_id)
+    )
+    for collection_id, book_id in rows:
+        book_ids[collection_id].append(book_id)
+    return book_ids
+
+
+def serialize_collections(collections):
+    book_ids = collection_book_ids([collection.id for collection in collections])
+    return [
+        {
+            "id": collection.id,
+            "name": collection.name,
+            "description": collection.description,
+            "book_ids": book_ids[collection.id],
+        }
+        for collection in collections
+    ]
 
 
 class BookCollectionNonID(Resource):
@@ -51,32 +126,48 @@ class BookCollectionNonID(Resource):
             collection = BookCollectiondb(
                 name=data["name"], description=data["description"]
             )
-            if "book_ids" in data:
-                books = (
-                    db.session.query(Bookdb)
-                    .filter(Bookdb.id.in_(data["book_ids"]))
-                    .all()
-                )
-                if len(books) != len(data["book_ids"]):
+            db.session.add(collection)
+            db.session.flush()
+            if data.get("book_ids"):
+                _, missing = add_books(collection.id, data["book_ids"])
+                if missing:
+                    db.session.rollback()
                     return {"error": "One or more book IDs are invalid"}, 400
-                collection.books = books
 
-            db.session.add(collection)
             db.session.commit()
             return {
                 "message": "Collection created",
                 "collection_id": collection.id,
             }, 201
+        except PoolTimeoutError:
+            raise
         except Exception as e:
             api.logger.error(f"Failed to insert collection! {e}")
             return {"error": "Failed to insert collection"}, 500
 
-    @api.doc(description="Search collections based on filters.")
+    @api.doc(
+        description="Search collections based on filters. \
+        Pass limit (and after) to use cursor pagination instead of page. \
+        Pass total=exact, cached, estimated or none to choose how the total \
+        is counted."
+    )
     @api.response(200, "Success")
+    @api.response(304, "Not Modified")
+    @api.response(400, "Validation Error")
     @api.response(500, "Internal Server Error")
     @api.expect(collection_filter_parser)
+    @read_only
     def get(self):
         args = collection_filter_parser.parse_args()
+
+        # Unchanged table means an unchanged page, checked before querying
+        etag = make_etag(
+            "collections", table_version("bookcollections"), query_signature()
+        )
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
         page = args["page"]
         per_page = args["per_page"]
         base_query = db.session.query(BookCollectiondb)
@@ -89,28 +180,44 @@ class BookCollectionNonID(Resource):
             base_query = base_query.filter(
                 BookCollectiondb.description.like(f"%{args['description']}%")
             )
+        search = args["q"].strip() if args["q"] else None
+        if search:
+            base_query = search_collections(base_query, search)
+
+        # Cursor pagination, ordered by id, skips OFFSET and COUNT(*)
+        if args["after"] is not None or args["limit"] is not None:
+            limit = args["limit"] if args["limit"] is not None else 10
+            collections, next_cursor, error = keyset_page(
+                base_query, BookCollectiondb.id, args["after"], limit
+            )
+            if error:
+                return {"error": error}, 400
+            data = {
+                "collections": serialize_collections(collections),
+                "next_cursor": next_cursor,
+            }
+            return data, 200, etag_headers(etag)
+
+        # Pages of a full-text search are ordered by relevance
+        if search:
+            base_query = rank_collections(base_query, search)
 
         # Apply pagination
-        pagination = base_query.paginate(page=page, per_page=per_page, error_out=False)
-        collections = pagination.items
+        signature = ["collections", args["name"], args["description"], search]
+        collections, pagination, error = offset_page(
+            base_query,
+            page,
+            per_page,
+            args["total"] or default_total_mode(),
+            signature,
+        )
+        if error:
+            return {"error": error}, 400
 
         # Prepare data for response
-        data = {
-            "collections": [
-                {
-                    "id": collection.id,
-                    "name": collection.name,
-                    "description": collection.description,
-                    "book_ids": [book.id for book in collection.books],
-                }
-                for collection in collections
-            ],
-            "total": pagination.total,
-            "pages": pagination.pages,
-            "page": page,
-        }
+        data = {"collections": serialize_collections(collections), **pagination}
 
-        return data, 200
+        return data, 200, etag_headers(etag)
 
 
 class BookCollectionID(Resource):
@@ -134,29 +241,86 @@ class BookCollectionID(Resource):
             collection.name = data.get("name", collection.name)
             collection.description = data.get("description", collection.description)
 
+            db.session.flush()
+
             if "book_ids" in data:
-                books = (
-                    db.session.query(Bookdb)
-                    .filter(Bookdb.id.in_(data["book_ids"]))
-                    .all()
-                )
-                if len(books) != len(data["book_ids"]):
+                # Only the difference to the current membership is written
+                added, missing = add_books(collection_id, data["book_ids"])
+                if missing:
+                    db.session.rollback()
                     return {"error": "One or more book IDs are invalid"}, 400
-                collection.books = books
+                removed = remove_books(collection_id, keep=data["book_ids"])
+                if added or removed:
+                    touch_collection(collection_id)
 
             db.session.commit()
             return {"message": f"Collection {collection_id} updated successfully"}, 200
+        except PoolTimeoutError:
+            raise
         except Exception as e:
             api.logger.error(
                 f"Failed to modify collection with id {collection_id}! {e}"
             )
             return {"error": "Failed to modify collection"}, 500
 
-    @api.doc(description="Retrieve a book collection.")
+    @api.doc(
+        description="Add and remove books without sending the whole collection. \
+        Books already in (or not in) the collection are ignored."
+    )
+    @api.response(200, "Membership updated")
+    @api.response(400, "Validation Error")
+    @api.response(404, "Collection not found")
+    @api.response(500, "Internal Server Error")
+    @api.expect(membership_model, validate=True)
+    def patch(self, collection_id):
+        data = request.json
+        add = data.get("add") or []
+        remove = data.get("remove") or []
+        if set(add) & set(remove):
+            return {"error": "A book can't be both added and removed"}, 400
+
+        try:
+            # Also tells whether the collection exists, without loading it
+            if not touch_collection(collection_id):
+                db.session.rollback()
+                return {"error": f"Collection with id {collection_id} not found"}, 404
+
+            added, missing = add_books(collection_id, add)
+            if missing:
+                db.session.rollback()
+                return {"error": "Invalid book IDs", "book_ids": missing}, 400
+            removed = remove_books(collection_id, remove)
+
+            if not added and not removed:
+                # Nothing changed, keep the version and so the ETag
+                db.session.rollback()
+            else:
+                db.session.commit()
+            return {
+                "message": f"Collection {collection_id} updated successfully",
+                "added": len(added),
+                "removed": removed,
+            }, 200
+        except PoolTimeoutError:
+            raise
+        except Exception as e:
+            db.session.rollback()
+            api.logger.error(
+                f"Failed to modify collection with id {collection_id}! {e}"
+            )
+            return {"error": "Failed to modify collection"}, 500
+
+    @api.doc(
+        description="Retrieve a book collection. Pass expand=books for the full books."
+    )
     @api.response(200, "Success")
+    @api.response(304, "Not Modified")
     @api.response(404, "Collection not found")
     @api.response(500, "Internal Server Error")
+    @api.expect(collection_parser)
+    @read_only
     def get(self, collection_id):
+        args = collection_parser.parse_args()
         collection = (
             db.session.query(BookCollectiondb)
             .filter(BookCollectiondb.id == collection_id)
@@ -165,16 +329,38 @@ class BookCollectionID(Resource):
         if not collection:
             return {"error": "Collection not found"}, 404
 
-        book_ids = [book.id for book in collection.books]
+        # The version changes with membership too, so a match skips loading it
+        etag_parts = ["collection", collection.id, collection.version]
+        if args["expand"] == "books":
+            # Inline books also change when any of them is edited
+            etag_parts += ["books", table_version("books")]
+        etag = make_etag(*etag_parts)
+        cached = not_modified(etag)
+        if cached:
+            return cached
 
-        collection_data = {
+        if args["expand"] != "books":
+            return serialize_collections([collection])[0], 200, etag_headers(etag)
+
+        # Members and their books in one query
+        books = (
+            db.session.query(Bookdb)
+            .join(
+                bookcollection_book_table,
+                bookcollection_book_table.c.book_id == Bookdb.id,
+            )
+            .filter(bookcollection_book_table.c.bookcollection_id == collection.id)
+            .order_by(Bookdb.id)
+            .all()
+        )
+        data = {
             "id": collection.id,
             "name": collection.name,
             "description": collection.description,
-            "book_ids": book_ids,
+            "book_ids": [book.id for book in books],
+            "books": serialize_book(books),
         }
-
-        return collection_data, 200
+        return data, 200, etag_headers(etag)
 
     @api.doc(description="Delete a book collection.")
     @api.response(200, "Collection deleted successfully.")
@@ -192,6 +378,8 @@ class BookCollectionID(Resource):
             db.session.delete(collection)
             db.session.commit()
             return {"message": f"Collection {collection_id} deleted successfully"}, 200
+        except PoolTimeoutError:
+            raise
         except Exception as e:
             api.logger.error(
                 f"Failed to delete collection with id {collection_id}! {e}"
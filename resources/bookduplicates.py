@@ -0,0 +1,169 @@
+# bookduplicates.py
+
+from flask_restx import Resource, fields, reqparse
+from flask import request
+
+from .api import api
+from .book import book_model
+from db.models import db
+from db.duplicates import duplicate_groups, find_duplicates
+from db.routing import read_only
+from db.versions import table_version
+from utils.conditional import etag_headers, make_etag, not_modified, query_signature
+from utils.serializers import compile_marshal
+
+
+# Most books one batch lookup may check, duplicates returned per book and
+# title keys checked per report page
+MAX_LOOKUP_BOOKS = 1000
+MAX_DUPLICATES = 100
+MAX_REPORT_KEYS = 500
+
+duplicate_model = api.model(
+    "BookDuplicate",
+    {
+        "book": fields.Nested(book_model),
+        "score": fields.Float(description="Similarity from 0 to 1"),
+    },
+)
+serialize_duplicate = compile_marshal(duplicate_model)
+
+duplicate_list_model = api.model(
+    "BookDuplicateList", {"duplicates": fields.List(fields.Nested(duplicate_model))}
+)
+
+duplicate_lookup_model = api.model(
+    "BookDuplicateLookup",
+    {
+        "books": fields.List(
+            fields.Nested(
+                api.model(
+                    "BookDuplicateLookupBook",
+                    {
+                        "title": fields.String(required=True),
+                        "author": fields.String(required=True),
+                    },
+                )
+            ),
+            required=True,
+        )
+    },
+)
+
+duplicate_group_model = api.model(
+    "BookDuplicateGroup", {"books": fields.List(fields.Nested(book_model))}
+)
+
+duplicate_report_model = api.model(
+    "BookDuplicateReport",
+    {
+        "groups": fields.List(fields.Nested(duplicate_group_model)),
+        "next_cursor": fields.String,
+    },
+)
+serialize_duplicate_report = compile_marshal(duplicate_report_model)
+
+duplicates_parser = reqparse.RequestParser()
+duplicates_parser.add_argument("title", required=True, help="Title of the book")
+duplicates_parser.add_argument("author", required=True, help="Author of the book")
+duplicates_parser.add_argument(
+    "limit", type=int, default=5, help="Most duplicates to return"
+)
+
+report_parser = reqparse.RequestParser()
+report_parser.add_argument(
+    "limit", type=int, default=50, help="Title keys shared by several books to check"
+)
+report_parser.add_argument(
+    "after", required=False, help="Cursor returned as next_cursor by the previous page"
+)
+
+
+def serialize_duplicates(duplicates):
+    """(Book, score) pairs from find_duplicates() as duplicate_model dicts."""
+    return serialize_duplicate(
+        [{"book": book, "score": score} for book, score in duplicates]
+    )
+
+
+class BookDuplicates(Resource):
+    @api.doc(
+        description="Find existing books that are near duplicates of a title \
+        and author, before adding the book."
+    )
+    @api.expect(duplicates_parser)
+    @api.response(200, "Success", duplicate_list_model)
+    @api.response(304, "Not Modified")
+    @api.response(400, "Validation Error")
+    @read_only
+    def get(self):
+        args = duplicates_parser.parse_args()
+        if args["limit"] < 1 or args["limit"] > MAX_DUPLICATES:
+            return {"error": f"Limit must be between 1 and {MAX_DUPLICATES}"}, 400
+
+        etag = make_etag("duplicates", table_version("books"), query_signature())
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        duplicates = find_duplicates(
+            db.session,
+            [{"title": args["title"], "author": args["author"]}],
+            args["limit"],
+        )[0]
+        body = {"duplicates": serialize_duplicates(duplicates)}
+        return body, 200, etag_headers(etag)
+
+    @api.doc(
+        description="Find the near duplicates of many books with one lookup, \
+        e.g. before a bulk import. Results are in the order of the books."
+    )
+    @api.expect(duplicate_lookup_model, validate=True)
+    @api.response(200, "Success")
+    @api.response(400, "Validation Error")
+    @read_only
+    def post(self):
+        books = request.json["books"]
+        if not books:
+            return {"error": "books must not be empty"}, 400
+        if len(books) > MAX_LOOKUP_BOOKS:
+            return {
+                "error": f"At most {MAX_LOOKUP_BOOKS} books can be checked at once"
+            }, 400
+
+        duplicates = find_duplicates(db.session, books)
+        body = {"duplicates": [serialize_duplicates(found) for found in duplicates]}
+        return body, 200
+
+
+class BookDuplicateReport(Resource):
+    @api.doc(
+        description="Report groups of near-duplicate books in the whole database. \
+        Books are grouped by a normalized title key and only compared within \
+        their group, pass the returned next_cursor as after for the next page."
+    )
+    @api.expect(report_parser)
+    @api.response(200, "Success", duplicate_report_model)
+    @api.response(304, "Not Modified")
+    @api.response(400, "Validation Error")
+    @read_only
+    def get(self):
+        args = report_parser.parse_args()
+        if args["limit"] < 1 or args["limit"] > MAX_REPORT_KEYS:
+            return {"error": f"Limit must be between 1 and {MAX_REPORT_KEYS}"}, 400
+
+        etag = make_etag("duplicate-report", table_version("books"), query_signature())
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        groups, next_cursor = duplicate_groups(
+            db.session, args["limit"], args["after"]
+        )
+        body = serialize_duplicate_report(
+            {
+                "groups": [{"books": books} for books in groups],
+                "next_cursor": next_cursor,
+            }
+        )
+        return body, 200, etag_headers(etag)
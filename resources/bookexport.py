@@ -0,0 +1,97 @@
+# bookexport.py
+
+import csv
+import io
+import json
+
+from flask_restx import Resource, reqparse
+from flask import Response, request, stream_with_context
+
+from .api import api
+from .booklist import filter_books
+from db.models import db
+from db.models import Book as Bookdb
+from db.booktypes import booktypes
+from db.routing import read_only
+
+
+# Rows fetched from the database cursor at a time
+EXPORT_CHUNK_SIZE = 1000
+
+EXPORT_COLUMNS = ["id", "title", "author", "type", "year"]
+
+export_parser = reqparse.RequestParser()
+export_parser.add_argument(
+    "format", choices=["ndjson", "csv"], default="ndjson", help="Output format"
+)
+export_parser.add_argument(
+    "q", required=False, help="Full-text search in title and author"
+)
+export_parser.add_argument("title", required=False, help="Search by title")
+export_parser.add_argument("author", required=False, help="Search by author")
+export_parser.add_argument(
+    "book_type", required=False, help="Search by type, 'fiction' or 'non-fiction'"
+)
+export_parser.add_argument("year", type=int, required=False, help="Search by year")
+
+
+def with_type_names(rows):
+    for book_id, title, author, type_id, year in rows:
+        yield book_id, title, author, booktypes.name_for(type_id), year
+
+
+def export_ndjson(rows):
+    for row in with_type_names(rows):
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n"
+
+
+def export_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(row):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        return buffer.getvalue()
+
+    yield line(EXPORT_COLUMNS)
+    for row in with_type_names(rows):
+        yield line(row)
+
+
+class BookExport(Resource):
+    @api.doc(
+        description="Stream every book matching the filters as NDJSON or CSV. \
+        Rows are read through a server-side cursor, so memory use does not \
+        grow with the size of the table."
+    )
+    @api.expect(export_parser)
+    @api.response(200, "Success")
+    @api.response(400, "Validation Error")
+    @read_only
+    def get(self):
+        args = export_parser.parse_args()
+
+        query = db.session.query(
+            Bookdb.id, Bookdb.title, Bookdb.author, Bookdb.type_id, Bookdb.year
+        )
+        query, error = filter_books(query, request.args)
+        if error:
+            return {"error": error}, 400
+
+        # Load the type cache now rather than while the cursor is open
+        booktypes.names()
+
+        # yield_per streams results (server-side cursor on Postgres)
+        rows = query.order_by(Bookdb.id).yield_per(EXPORT_CHUNK_SIZE)
+
+        if args["format"] == "csv":
+            return Response(
+                stream_with_context(export_csv(rows)),
+                mimetype="text/csv",
+                headers={"Content-Disposition": "attachment; filename=books.csv"},
+            )
+        return Response(
+            stream_with_context(export_ndjson(rows)), mimetype="application/x-ndjson"
+        )
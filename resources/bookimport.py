@@ -0,0 +1,227 @@
+# bookimport.py
+
+import csv
+import json
+
+from flask_restx import Resource, fields, inputs, reqparse
+from flask import request
+from sqlalchemy import insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from .api import api
+from db.models import db
+from db.models import Book as Bookdb
+from db.booktypes import booktypes
+from db.duplicates import earlier_duplicates, find_duplicates
+from db.versions import bump_table_version
+from utils.cache import book_filter_values, book_search_cache
+from utils.utils import validate_book
+
+
+MAX_BATCH_SIZE = 10000
+
+import_error_model = api.model(
+    "BookImportError",
+    {
+        "row": fields.Integer(description="1-based row number in the body"),
+        "error": fields.String,
+        "duplicates": fields.List(
+            fields.Integer, description="Ids of existing near duplicates"
+        ),
+    },
+)
+
+import_report_model = api.model(
+    "BookImportReport",
+    {
+        "inserted": fields.Integer,
+        "failed": fields.Integer,
+        "errors": fields.List(fields.Nested(import_error_model)),
+    },
+)
+
+import_parser = reqparse.RequestParser()
+import_parser.add_argument(
+    "format",
+    choices=["ndjson", "csv"],
+    location="args",
+    help="Body format, defaults to the request Content-Type",
+)
+import_parser.add_argument(
+    "batch_size",
+    type=int,
+    default=1000,
+    location="args",
+    help="Rows inserted per statement and commit",
+)
+import_parser.add_argument(
+    "check_duplicates",
+    type=inputs.boolean,
+    default=False,
+    location="args",
+    help="Skip and report rows that nearly duplicate a book or an earlier row",
+)
+
+
+def decode_lines(stream, bad_lines):
+    """
+    Decode the body line by line, as not every server's input stream is a
+    full io object that TextIOWrapper can wrap (gunicorn's isn't). Lines that
+    aren't UTF-8 are decoded with replacement characters and their 1-based
+    numbers added to `bad_lines`.
+    """
+    for number, line in enumerate(stream, start=1):
+        try:
+            yield line.decode("utf-8")
+        except UnicodeDecodeError:
+            bad_lines.add(number)
+            yield line.decode("utf-8", "replace")
+
+
+def read_rows(stream, body_format):
+    """Yield (row number, row dict or error message) pairs from the body."""
+    bad_lines = set()
+    text = decode_lines(stream, bad_lines)
+    if body_format == "csv":
+        reader = csv.DictReader(text)
+        last_line = 1
+        for number, row in enumerate(reader, start=1):
+            # A quoted value can span several lines of the body
+            lines = range(last_line + 1, reader.line_num + 1)
+            last_line = reader.line_num
+            if any(line in bad_lines for line in lines):
+                yield number, "Row is not valid UTF-8"
+                continue
+            # Short rows leave None for missing columns, treat them as absent
+            yield number, {k: v for k, v in row.items() if k and v is not None}
+        return
+
+    for number, line in enumerate(text, start=1):
+        if number in bad_lines:
+            yield number, "Row is not valid UTF-8"
+            continue
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, "Row is not valid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield number, "Row must be a JSON object"
+            continue
+        yield number, row
+
+
+class BookImport(Resource):
+    @api.doc(
+        description="Bulk insert books from a streamed NDJSON or CSV body. \
+        Rows are validated like a single book POST and inserted in batches. \
+        Invalid rows are reported and skipped instead of failing the import. \
+        With check_duplicates=true near duplicates are reported and skipped too."
+    )
+    @api.expect(import_parser)
+    @api.response(
+        200, "Import finished, see the per-row report", import_report_model
+    )
+    @api.response(400, "Validation Error")
+    def post(self):
+        args = import_parser.parse_args()
+        batch_size = args["batch_size"]
+        if batch_size < 1 or batch_size > MAX_BATCH_SIZE:
+            return {
+                "error": f"Batch size must be between 1 and {MAX_BATCH_SIZE}"
+            }, 400
+
+        body_format = args["format"]
+        if body_format is None:
+            body_format = "csv" if request.mimetype == "text/csv" else "ndjson"
+
+        report = {"inserted": 0, "failed": 0, "errors": []}
+        batch = []
+
+        def skip_duplicates():
+            # One lookup per batch; earlier batches are committed by now
+            books = [values for _, values in batch]
+            existing = find_duplicates(db.session, books)
+            earlier = earlier_duplicates(books)
+            kept = []
+            for (number, values), found, other in zip(batch, existing, earlier):
+                if found:
+                    error = {
+                        "row": number,
+                        "error": "Book may already exist",
+                        "duplicates": [book.id for book, _ in found],
+                    }
+                elif other is not None:
+                    error = {
+                        "row": number,
+                        "error": f"Book may repeat row {batch[other][0]}",
+                    }
+                else:
+                    kept.append((number, values))
+                    continue
+                report["failed"] += 1
+                report["errors"].append(error)
+            batch[:] = kept
+
+        def flush():
+            try:
+                if args["check_duplicates"]:
+                    skip_duplicates()
+                    if not batch:
+                        return
+                db.session.execute(insert(Bookdb), [values for _, values in batch])
+                # Core inserts skip the ORM hook that keeps list ETags fresh
+                bump_table_version(db.session.connection(), "books")
+                db.session.commit()
+                book_search_cache.invalidate(
+                    [
+                        book_filter_values(
+                            values["title"],
+                            values["author"],
+                            values["year"],
+                            values["type_id"],
+                        )
+                        for _, values in batch
+                    ]
+                )
+                report["inserted"] += len(batch)
+            except PoolTimeoutError:
+                db.session.rollback()
+                raise
+            except Exception as e:
+                db.session.rollback()
+                api.logger.error(f"Failed to insert a batch of books! {e}")
+                for number, _ in batch:
+                    report["failed"] += 1
+                    report["errors"].append(
+                        {"row": number, "error": "Book wasn't inserted"}
+                    )
+            batch.clear()
+
+        for number, row in read_rows(request.stream, body_format):
+            error = row if isinstance(row, str) else validate_book(row)
+            if error:
+                report["failed"] += 1
+                report["errors"].append({"row": number, "error": error})
+                continue
+
+            batch.append(
+                (
+                    number,
+                    {
+                        "title": row["title"],
+                        "author": row["author"],
+                        "type_id": booktypes.id_for(row["type"]),
+                        "year": int(row["year"]),
+                    },
+                )
+            )
+            if len(batch) >= batch_size:
+                flush()
+
+        if batch:
+            flush()
+
+        return report, 200
@@ -1,45 +1,80 @@
 # booklist.py
 
-from flask_restx import Resource, fields, reqparse
+from flask_restx import Resource, fields, inputs, reqparse
 from flask import request
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 from .api import api
+from .book import book_model
+from .bookduplicates import serialize_duplicates
 from db.models import db
 from db.models import Book as Bookdb
-from db.models import BookType as BookTypedb
-from utils.utils import is_integer
+from db.booktypes import booktypes
+from db.duplicates import find_duplicates
+from db.routing import pinned_to_primary, read_only
+from db.search import rank_books, search_books
+from db.stats import FACETS, book_facets
+from db.versions import table_version
+from utils.conditional import etag_headers, make_etag, not_modified, query_signature
+from utils.utils import is_integer, validate_book
+from utils.pagination import TOTAL_MODES, default_total_mode, keyset_page
+from utils.pagination import offset_page
+from utils.cache import BOOK_FILTERS, book_search_cache
+from utils.serializers import compile_marshal
 
 
-# defining book_model again cuz i am retarded so this is TODO
-book_model = api.model(
-    "Book",
+# Define list of books model
+book_list_model = api.model(
+    "BookList",
     {
-        "id": fields.Integer,
-        "title": fields.String,
-        "author": fields.String,
-        "type": fields.String(
-            attribute=lambda book: book.type.name
-            if type(book) == Bookdb and book.type
-            else None
-        ),
-        "year": fields.Integer,
+        "books": fields.List(fields.Nested(book_model)),
+        "total": fields.Integer(description="Null in the none total mode"),
+        "pages": fields.Integer(description="Null in the none total mode"),
+        "page": fields.Integer,
+        "total_mode": fields.String(description="How total was computed"),
     },
 )
 
-# Define list of books model
-book_list_model = api.model(
-    "BookList", {"books": fields.List(fields.Nested(book_model))}
+# List of books returned by the cursor (keyset) pagination mode
+book_cursor_list_model = api.model(
+    "BookCursorList",
+    {
+        "books": fields.List(fields.Nested(book_model)),
+        "next_cursor": fields.String,
+    },
 )
 
+# Compiled once, the hot paths below don't walk the field definitions per book
+serialize_book_list = compile_marshal(book_list_model)
+serialize_book_cursor_list = compile_marshal(book_cursor_list_model)
+
+MAX_YEAR_BUCKET = 1000
+MAX_FACET_TOP = 100
+
 parser = reqparse.RequestParser()
 parser.add_argument("page", type=int, default=1, help="Page number")
 parser.add_argument("per_page", type=int, default=10, help="Books per page")
+parser.add_argument(
+    "total",
+    choices=TOTAL_MODES,
+    required=False,
+    help="How total and pages are computed, defaults to PAGINATION_TOTAL",
+)
+parser.add_argument(
+    "after", required=False, help="Cursor returned as next_cursor by the previous page"
+)
+parser.add_argument(
+    "limit", type=int, required=False, help="Books per page in cursor mode"
+)
+parser.add_argument(
+    "q", required=False, help="Full-text search in title and author"
+)
 parser.add_argument("title", required=False, help="Search by title")
 parser.add_argument("author", required=False, help="search by Author.")
 parser.add_argument(
     "type",
     required=False,
-    help="Search by type, only 'fiction' or 'non-fiction' exists.",
+    help="Search by type, e.g. 'fiction' or 'non-fiction'.",
 )
 parser.add_argument(
     "year",
@@ -47,105 +82,251 @@ parser.add_argument(
     required=False,
     help="Year cannot be blank and must be an integer lesser than 10000.",
 )
+parser.add_argument(
+    "facets",
+    required=False,
+    help="Comma separated counts to return for all matching books: "
+    + ", ".join(FACETS),
+)
+parser.add_argument(
+    "year_bucket", type=int, default=10, help="Years per bucket of the year facet"
+)
+parser.add_argument(
+    "facet_top", type=int, default=10, help="Authors in the author facet"
+)
+
+post_parser = reqparse.RequestParser()
+post_parser.add_argument(
+    "check_duplicates",
+    type=inputs.boolean,
+    default=False,
+    location="args",
+    help="Refuse the book with 409 if near duplicates of it already exist",
+)
+
+
+def filter_books(query, params):
+    """
+    Apply the book search filters from the query string `params` to `query`.
+    Returns (query, error) where error is a message for a 400 response.
+    """
+    if "author" in params:
+        query = query.filter(Bookdb.author == params["author"])
+
+    if "title" in params:
+        query = query.filter(Bookdb.title == params["title"])
+
+    if "year" in params:
+        year = params["year"]
+        if len(year) > 4:
+            return None, "Year is too long"
+        if not is_integer(year):
+            return None, "Year is not an integer"
+        query = query.filter(Bookdb.year == year)
+
+    if "book_type" in params:
+        type_id = booktypes.id_for(params["book_type"])
+        if type_id is None:
+            return None, booktypes.invalid_type_message()
+        query = query.filter(Bookdb.type_id == type_id)
+
+    if params.get("q", "").strip():
+        query = search_books(query, params["q"])
+
+    return query, None
+
+
+def parse_facets(args):
+    """Returns (facet names, error) from the facets parameter."""
+    if not args["facets"]:
+        return [], None
+    names = []
+    for name in args["facets"].split(","):
+        name = name.strip()
+        if name not in FACETS:
+            return None, "facets must be one or more of " + ", ".join(FACETS)
+        if name not in names:
+            names.append(name)
+    if args["year_bucket"] < 1 or args["year_bucket"] > MAX_YEAR_BUCKET:
+        return None, f"year_bucket must be between 1 and {MAX_YEAR_BUCKET}"
+    if args["facet_top"] < 1 or args["facet_top"] > MAX_FACET_TOP:
+        return None, f"facet_top must be between 1 and {MAX_FACET_TOP}"
+    return names, None
+
+
+def facet_counts(query, names, args):
+    """The facets `names` of the books matched by `query`, for the response."""
+    filtered = any(name in request.args for name in BOOK_FILTERS) or (
+        request.args.get("q", "").strip()
+    )
+    facets = book_facets(
+        db.session,
+        query if filtered else None,
+        names,
+        args["year_bucket"],
+        args["facet_top"],
+    )
+    data = {}
+    if "type" in facets:
+        data["type"] = [
+            {"type": booktypes.name_for(type_id), "count": count}
+            for type_id, count in facets["type"]
+        ]
+    if "year" in facets:
+        data["year"] = [
+            {"from": year, "to": year + args["year_bucket"] - 1, "count": count}
+            for year, count in facets["year"]
+        ]
+    if "author" in facets:
+        data["author"] = [
+            {"author": author, "count": count} for author, count in facets["author"]
+        ]
+    return data
+
+
+def search_page(args):
+    """Run a book search for one page, returns (body, status)."""
+    # Base query
+    query = db.session.query(Bookdb)
+
+    query, error = filter_books(query, request.args)
+    if error:
+        return {"error": error}, 400
+    facets, error = parse_facets(args)
+    if error:
+        return {"error": error}, 400
+    # Facets count every book the filters match, not only this page
+    matched = query
+
+    # Cursor pagination, ordered by id, skips OFFSET and COUNT(*)
+    if args["after"] is not None or args["limit"] is not None:
+        limit = args["limit"] if args["limit"] is not None else 10
+        books, next_cursor, error = keyset_page(
+            query, Bookdb.id, args["after"], limit
+        )
+        if error:
+            return {"error": error}, 400
+        if not books:
+            return {"error": "No books found"}, 404
+        data = {"books": books, "next_cursor": next_cursor}
+        body = serialize_book_cursor_list(data)
+        if facets:
+            body["facets"] = facet_counts(matched, facets, args)
+        return body, 200
+
+    # Pages of a full-text search are ordered by relevance
+    if request.args.get("q", "").strip():
+        query = rank_books(query, request.args["q"])
+
+    # Pagination
+    page = args["page"]
+    per_page = args["per_page"]
+    # The filters alone, every page of a search shares the cached total
+    signature = ["books"] + [
+        [name, request.args[name]]
+        for name in BOOK_FILTERS + ["q"]
+        if name in request.args
+    ]
+    books, pagination, error = offset_page(
+        query, page, per_page, args["total"] or default_total_mode(), signature
+    )
+    if error:
+        return {"error": error}, 400
+
+    if not books:
+        return {"error": "No books found"}, 404
+
+    data = {"books": books, **pagination}
+    # Same output as api.marshal(data, book_list_model)
+    body = serialize_book_list(data)
+    if facets:
+        body["facets"] = facet_counts(matched, facets, args)
+    return body, 200
 
 
 class BookList(Resource):
     @api.doc(
         description="Retrieve a list of books based on query parameters. \
-        Can filter by id, author, title, year, and type."
+        Can filter by id, author, title, year, and type, \
+        and search titles and authors with q. \
+        Pass limit (and after) to use cursor pagination instead of page. \
+        Pass total=exact, cached, estimated or none to choose how the total \
+        is counted. \
+        Pass facets to also get the number of matching books per type, \
+        per year_bucket years and for the facet_top authors."
     )
     @api.expect(parser)
     @api.response(200, "Success")
+    @api.response(304, "Not Modified")
     @api.response(400, "Validation Error")
     @api.response(404, "No Books Found")
     @api.response(500, "Internal Server Error")
+    @read_only
     def get(self):
         # Add other filters as needed
         args = parser.parse_args()
 
-        # Base query
-        query = db.session.query(Bookdb)
-
-        if "author" in request.args:
-            query = query.filter(Bookdb.author == request.args["author"])
-
-        if "title" in request.args:
-            query = query.filter(Bookdb.title == request.args["title"])
-
-        if "year" in request.args:
-            year = request.args["year"]
-            if len(year) > 4:
-                return {"error": "Year is too long"}, 400
-            if not is_integer(year):
-                return {"error": "Year is not an integer"}, 400
-            query = query.filter(db.Book.year == year)
+        # Unchanged table means an unchanged page, checked before querying
+        etag = make_etag("books", table_version("books"), query_signature())
+        cached = not_modified(etag)
+        if cached:
+            return cached
 
-        if "book_type" in request.args:
-            book_type = request.args["book_type"]
-            if book_type not in ["fiction", "non-fiction"]:
-                return {"error": 'Type must be "fiction" or "non-fiction"'}, 400
-            query = query.filter(Bookdb.type.has(name=book_type))
+        # Repeated searches are answered from the result cache, except for
+        # clients that just wrote: an entry may come from a lagging replica
+        key = book_search_cache.key(request.args)
+        hit = None if pinned_to_primary() else book_search_cache.get(key)
+        if hit:
+            body, status = hit
+            return body, status, etag_headers(etag)
 
-        # Pagination
-        page = args["page"]
-        per_page = args["per_page"]
-        pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-        books = pagination.items
+        body, status = search_page(args)
+        if status in (200, 404):
+            book_search_cache.set(key, body, status)
+        return body, status, etag_headers(etag)
 
-        if not books:
-            return {"error": "No books found"}, 404
-
-        # Use the api.marshal to serialize the list of books
-        data = {
-            "books": books,
-            "total": pagination.total,
-            "pages": pagination.pages,
-            "page": page,
-        }
-        # New TODO, rewrite to book_model
-        return api.marshal(data, book_list_model), 200
-
-    @api.doc(description="Add a new book to the database.")
-    @api.expect(book_model, validate=True)
+    @api.doc(
+        description="Add a new book to the database. \
+        Pass check_duplicates=true to refuse near duplicates of existing books."
+    )
+    @api.expect(book_model, post_parser, validate=True)
     @api.marshal_with(book_model)
     @api.response(201, "Book Created")
     @api.response(400, "Validation Error")
+    @api.response(409, "Near duplicates of the book exist")
     @api.response(500, "Internal Server Error")
     def post(self):
+        args = post_parser.parse_args()
         # Get the JSON data from the request
         data = request.json
         if data is None:
             return {"error": "No JSON data provided"}, 400
 
-        if "title" not in data:
-            return {"error": 'Missing "title" field in JSON data'}, 400
-        if "author" not in data:
-            return {"error": 'Missing "author" field in JSON data'}, 400
-        if "type" not in data:
-            return {"error": 'Missing "type" field in JSON data'}, 400
-        if data["type"] not in ["fiction", "non-fiction"]:
-            return {"error": 'Type must be "fiction" or "non-fiction"'}, 400
-        if "year" not in data:
-            return {"error": 'Missing "year" field in JSON data'}, 400
-        if not is_integer(data["year"]):
-            return {"error": "Year is not an integer"}, 400
-        if len(str(data["year"])) > 4:
-            return {"error": "Year is too long"}, 400
+        error = validate_book(data)
+        if error:
+            return {"error": error}, 400
+
+        if args["check_duplicates"]:
+            duplicates = find_duplicates(db.session, [data])[0]
+            if duplicates:
+                # Raised, marshal_with would drop the duplicates from a return
+                api.abort(
+                    409,
+                    error="Book may already exist",
+                    duplicates=serialize_duplicates(duplicates),
+                )
 
         try:
-            booktype = (
-                db.session.query(BookTypedb)
-                .filter(BookTypedb.name == data["type"])
-                .first()
-            )
             book = Bookdb(
                 title=data["title"],
                 author=data["author"],
-                type_id=booktype.id,
+                type_id=booktypes.id_for(data["type"]),
                 year=data["year"],
             )
             db.session.add(book)
             db.session.commit()
+        except PoolTimeoutError:
+            raise
         except Exception as e:
             api.logger.error(f"Failed to insert a book! {e}")
             return {"error": "Book wasn't inserted"}, 500
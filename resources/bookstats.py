@@ -0,0 +1,80 @@
+# bookstats.py
+
+from flask_restx import Resource, reqparse
+
+from .api import api
+from db.models import db
+from db.models import BookCollection as BookCollectiondb
+from db.booktypes import booktypes
+from db.routing import read_only
+from db.stats import books_per_author, books_per_collection
+from db.stats import books_per_type, books_per_year
+from db.versions import table_version
+from utils.conditional import etag_headers, make_etag, not_modified, query_signature
+
+
+MAX_TOP = 1000
+
+stats_parser = reqparse.RequestParser()
+stats_parser.add_argument(
+    "top",
+    type=int,
+    default=20,
+    help="Number of authors and collections with the most books to return",
+)
+
+
+class BookStats(Resource):
+    @api.doc(
+        description="Number of books in total, per year, per type, and for the \
+        authors and collections with the most books."
+    )
+    @api.expect(stats_parser)
+    @api.response(200, "Success")
+    @api.response(304, "Not Modified")
+    @api.response(400, "Validation Error")
+    @read_only
+    def get(self):
+        args = stats_parser.parse_args()
+        top = args["top"]
+        if top < 1 or top > MAX_TOP:
+            return {"error": f"top must be between 1 and {MAX_TOP}"}, 400
+
+        etag = make_etag(
+            "stats",
+            table_version("books"),
+            table_version("bookcollections"),
+            query_signature(),
+        )
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        by_year = books_per_year(db.session)
+        collections = books_per_collection(db.session, top)
+        names = dict(
+            db.session.query(BookCollectiondb.id, BookCollectiondb.name).filter(
+                BookCollectiondb.id.in_([row[0] for row in collections])
+            )
+        )
+        data = {
+            "books": sum(count for _, count in by_year),
+            "by_year": [{"year": year, "count": count} for year, count in by_year],
+            "by_type": [
+                {"type": booktypes.name_for(type_id), "count": count}
+                for type_id, count in books_per_type(db.session)
+            ],
+            "by_author": [
+                {"author": author, "count": count}
+                for author, count in books_per_author(db.session, top)
+            ],
+            "by_collection": [
+                {
+                    "collection_id": collection_id,
+                    "name": names.get(collection_id),
+                    "count": count,
+                }
+                for collection_id, count in collections
+            ],
+        }
+        return data, 200, etag_headers(etag)
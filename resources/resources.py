@@ -2,10 +2,21 @@
 from .api import api
 from .book import Book
 from .booklist import BookList
+from .bookimport import BookImport
+from .bookexport import BookExport
+from .bookbatch import BookBatch
+from .bookstats import BookStats
+from .bookduplicates import BookDuplicates, BookDuplicateReport
 from .bookcollection import BookCollectionNonID, BookCollectionID
 
 
 api.add_resource(Book, "/books/<int:book_id>")
 api.add_resource(BookList, "/books")
+api.add_resource(BookImport, "/books/import")
+api.add_resource(BookExport, "/books/export")
+api.add_resource(BookBatch, "/books/batch")
+api.add_resource(BookStats, "/stats")
+api.add_resource(BookDuplicates, "/books/duplicates")
+api.add_resource(BookDuplicateReport, "/books/duplicates/report")
 api.add_resource(BookCollectionNonID, "/collections")
 api.add_resource(BookCollectionID, "/collections/<int:collection_id>")
@@ -0,0 +1,67 @@
+# server.py
+#
+# Production entry point: python server.py
+# Runs the app under gunicorn with pre-forked workers instead of the
+# single-process Werkzeug development server started by app.py. The database
+# must be initialized first with python -m db.migrations, serving processes
+# don't create or change any tables.
+
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from app import create_app
+from db.models import db
+
+
+def post_fork(server, worker):
+    # Pooled connections opened in the master while preloading must not be
+    # shared with the children, every worker starts with empty pools
+    app = server.app.application
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def server_options():
+    """gunicorn settings, each overridable with an environment variable."""
+    return {
+        "bind": os.getenv("BIND", "0.0.0.0:5000"),
+        "workers": int(
+            os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1)
+        ),
+        "threads": int(os.getenv("THREADS", "4")),
+        "worker_class": "gthread",
+        # Import the app once in the master, workers fork from it
+        "preload_app": True,
+        # Recycle workers after this many requests (with jitter, so they don't
+        # all restart at once) to bound memory growth
+        "max_requests": int(os.getenv("MAX_REQUESTS", "10000")),
+        "max_requests_jitter": int(os.getenv("MAX_REQUESTS_JITTER", "1000")),
+        "timeout": int(os.getenv("WORKER_TIMEOUT", "30")),
+        # On SIGTERM workers finish in-flight requests for this long
+        "graceful_timeout": int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+        "keepalive": int(os.getenv("KEEPALIVE", "5")),
+        "accesslog": os.getenv("ACCESS_LOG"),
+        "post_fork": post_fork,
+    }
+
+
+class ProductionServer(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+if __name__ == "__main__":
+    ProductionServer(create_app(), server_options()).run()
@@ -0,0 +1,472 @@
+# benchmarks.py
+#
+# In-process benchmarks of every resource method against a seeded SQLite
+# database, compared with the stored baseline in benchmark_baseline.json:
+#
+#   python -m testing.benchmarks            # fails (exit code 1) on regression
+#   python -m testing.benchmarks --update   # accept the current numbers
+#
+# A benchmark regresses when it runs more SQL statements than its baseline,
+# or when its median wall time exceeds the baseline by more than the
+# tolerance. Statement counts are exact and don't depend on the machine;
+# timings do, so refresh the baseline with --update on the machine that runs
+# the gate.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event, insert
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A benchmark is slower only if it's both this much slower relatively...
+DEFAULT_TOLERANCE = 1.0
+# ...and by more than this many milliseconds, sub-millisecond noise is ignored
+TIME_SLACK_MS = 0.5
+
+
+class Measurement:
+    """Wall time and SQL statements of the `measure` blocks of one benchmark."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.times = []
+        self.statements = []
+        self.enabled = True
+
+    @contextmanager
+    def __call__(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", count)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            event.remove(self.engine, "before_cursor_execute", count)
+            if self.enabled:
+                self.times.append(elapsed)
+                self.statements.append(len(statements))
+
+    def result(self):
+        return {
+            "statements": max(self.statements),
+            "time_ms": round(1000 * statistics.median(self.times), 3),
+        }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return a list of regression messages, empty if there are none."""
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result["statements"] > expected["statements"]:
+            regressions.append(
+                f"{name}: {result['statements']} SQL statements, "
+                f"baseline {expected['statements']}"
+            )
+        limit = max(
+            expected["time_ms"] * (1 + tolerance), expected["time_ms"] + TIME_SLACK_MS
+        )
+        if result["time_ms"] > limit:
+            regressions.append(
+                f"{name}: {result['time_ms']:.3f} ms, baseline "
+                f"{expected['time_ms']:.3f} ms (limit {limit:.3f} ms)"
+            )
+    return regressions
+
+
+def book_row(number):
+    return {
+        "title": f"Benchmark title {number % 997}",
+        "author": f"Author {number % 211}",
+        "type_id": 1 + number % 2,
+        "year": 1900 + number % 120,
+    }
+
+
+def seed(db, books, collections, collection_size):
+    from db.models import Book, BookCollection, bookcollection_book_table
+    from db.versions import bump_table_version
+
+    db.session.execute(insert(Book), [book_row(i) for i in range(books)])
+    db.session.execute(
+        insert(BookCollection),
+        [
+            {"name": f"Collection {i}", "description": f"Benchmark collection {i}"}
+            for i in range(collections)
+        ],
+    )
+    db.session.execute(
+        insert(bookcollection_book_table),
+        [
+            {"bookcollection_id": i + 1, "book_id": 1 + (i * 7919 + j) % books}
+            for i in range(collections)
+            for j in range(collection_size)
+        ],
+    )
+    bump_table_version(db.session.connection(), "books")
+    bump_table_version(db.session.connection(), "bookcollections")
+    db.session.commit()
+
+
+# Benchmarks get the test client, the seeded sizes and `measure`; only the
+# code inside `with measure():` is timed and counted
+
+
+def check(response, status=200):
+    # A benchmark of an error response would pass for the wrong reason
+    assert response.status_code == status, (response.status_code, response.json)
+
+
+NEW_BOOK = {"title": "New", "author": "Benchmark", "type": "fiction", "year": 2001}
+
+
+def book_get(client, sizes, measure):
+    with measure():
+        response = client.get(f"/books/books/{sizes['books'] // 2}")
+    check(response)
+
+
+def book_post(client, sizes, measure):
+    with measure():
+        response = client.post("/books/books", json=NEW_BOOK)
+    check(response, 201)
+    client.delete(f"/books/books/{response.json['id']}")
+
+
+def book_put(client, sizes, measure):
+    book = {**NEW_BOOK, "title": f"Updated {time.perf_counter()}"}
+    with measure():
+        response = client.put(f"/books/books/{sizes['books'] // 3}", json=book)
+    check(response)
+
+
+def book_delete(client, sizes, measure):
+    book_id = client.post("/books/books", json=NEW_BOOK).json["id"]
+    with measure():
+        response = client.delete(f"/books/books/{book_id}")
+    check(response)
+
+
+def book_list_page(client, sizes, measure):
+    with measure():
+        response = client.get("/books/books?author=Author 7&per_page=50&page=2")
+    check(response)
+
+
+def book_list_cursor(client, sizes, measure):
+    with measure():
+        response = client.get(
+            "/books/books?book_type=fiction&limit=100&after=" + sizes["cursor"]
+        )
+    check(response)
+
+
+def book_list_facets(client, sizes, measure):
+    with measure():
+        response = client.get(
+            "/books/books?book_type=fiction&limit=50&facets=type,year,author"
+        )
+    check(response)
+
+
+def book_search(client, sizes, measure):
+    with measure():
+        response = client.get("/books/books?q=title 42&limit=50")
+    check(response)
+
+
+def book_batch(client, sizes, measure):
+    ids = ",".join(str(1 + i * 37 % sizes["books"]) for i in range(100))
+    with measure():
+        response = client.get(f"/books/books/batch?ids={ids}")
+    check(response)
+
+
+def book_batch_post(client, sizes, measure):
+    ids = [1 + i * 37 % sizes["books"] for i in range(100)]
+    with measure():
+        response = client.post("/books/books/batch", json={"ids": ids})
+    check(response)
+
+
+def book_duplicates(client, sizes, measure):
+    with measure():
+        response = client.get(
+            "/books/books/duplicates?title=Benchmark titel 42&author=Author 42"
+        )
+    check(response)
+
+
+def book_export(client, sizes, measure):
+    with measure():
+        response = client.get("/books/books/export?author=Author 3")
+        response.get_data()
+    check(response)
+
+
+def book_import(client, sizes, measure):
+    body = "\n".join(json.dumps(NEW_BOOK) for _ in range(500))
+    with measure():
+        response = client.post(
+            "/books/books/import?batch_size=500",
+            data=body,
+            content_type="application/x-ndjson",
+        )
+    check(response)
+    assert response.json["inserted"] == 500
+
+
+def book_stats(client, sizes, measure):
+    with measure():
+        response = client.get("/books/stats")
+    check(response)
+
+
+def collection_list(client, sizes, measure):
+    with measure():
+        response = client.get("/books/collections?per_page=50")
+    check(response)
+
+
+def collection_list_cursor(client, sizes, measure):
+    with measure():
+        response = client.get("/books/collections?limit=50")
+    check(response)
+
+
+def collection_get(client, sizes, measure):
+    with measure():
+        response = client.get("/books/collections/1")
+    check(response)
+
+
+def collection_get_expanded(client, sizes, measure):
+    with measure():
+        response = client.get("/books/collections/1?expand=books")
+    check(response)
+
+
+def collection_post(client, sizes, measure):
+    collection = {"name": "New", "description": "New", "book_ids": list(range(1, 51))}
+    with measure():
+        response = client.post("/books/collections", json=collection)
+    check(response, 201)
+    client.delete(f"/books/collections/{response.json['collection_id']}")
+
+
+def collection_patch(client, sizes, measure):
+    change = {"add": [1, 2], "remove": [sizes["member"]]}
+    with measure():
+        response = client.patch("/books/collections/2", json=change)
+    check(response)
+    assert response.json["added"] == 2 and response.json["removed"] == 1
+    revert = {"add": change["remove"], "remove": change["add"]}
+    check(client.patch("/books/collections/2", json=revert))
+
+
+def collection_put(client, sizes, measure):
+    # Renames collection 3 and swaps one of its books, then restores it
+    collection = client.get("/books/collections/3").json
+    del collection["id"]
+    book_ids = collection["book_ids"]
+    change = {
+        **collection,
+        "name": f"Renamed {time.perf_counter()}",
+        "book_ids": book_ids[1:] + [1],
+    }
+    with measure():
+        response = client.put("/books/collections/3", json=change)
+    check(response)
+    check(client.put("/books/collections/3", json=collection))
+
+
+def collection_delete(client, sizes, measure):
+    collection = {"name": "New", "description": "New", "book_ids": list(range(1, 51))}
+    collection_id = client.post("/books/collections", json=collection).json[
+        "collection_id"
+    ]
+    with measure():
+        response = client.delete(f"/books/collections/{collection_id}")
+    check(response)
+
+
+BENCHMARKS = [
+    book_get,
+    book_post,
+    book_put,
+    book_delete,
+    book_list_page,
+    book_list_cursor,
+    book_list_facets,
+    book_search,
+    book_batch,
+    book_batch_post,
+    book_duplicates,
+    book_export,
+    book_import,
+    book_stats,
+    collection_list,
+    collection_list_cursor,
+    collection_get,
+    collection_get_expanded,
+    collection_post,
+    collection_put,
+    collection_patch,
+    collection_delete,
+]
+
+
+# Imports the app and builds it in a fresh interpreter, the way a worker
+# starts; any SQL statement here would be DDL or seeding on the serving path
+STARTUP_SCRIPT = """
+import json, time
+started = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, "before_cursor_execute", lambda *args: statements.append(1))
+from app import create_app
+create_app()
+elapsed = time.perf_counter() - started
+print(json.dumps({"statements": len(statements), "time": elapsed}))
+"""
+
+
+def startup(repeat):
+    times = []
+    statements = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            env={**os.environ, "PYTHONPATH": REPO_ROOT},
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        result = json.loads(output)
+        times.append(result["time"])
+        statements.append(result["statements"])
+    return {
+        "statements": max(statements),
+        "time_ms": round(1000 * statistics.median(times), 3),
+    }
+
+
+def run(args, directory):
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+
+    from app import create_app
+    from db.migrations import initialize
+    from db.models import db
+    from utils.cache import book_search_cache
+    from utils.pagination import encode_cursor
+
+    app = create_app()
+    with app.app_context():
+        initialize(db.engine)
+        seed(db, args.books, args.collections, args.collection_size)
+        engine = db.engine
+    sizes = {
+        "books": args.books,
+        "collections": args.collections,
+        "cursor": encode_cursor(args.books // 2),
+        # A book of collection 2, see seed()
+        "member": 1 + 7919 % args.books,
+    }
+
+    client = app.test_client()
+    results = {}
+    for benchmark in BENCHMARKS:
+        if args.only and benchmark.__name__ not in args.only:
+            continue
+        measure = Measurement(engine)
+        for i in range(args.warmup + args.repeat):
+            measure.enabled = i >= args.warmup
+            # Every run misses the result cache, it is measured by itself
+            book_search_cache.backend.clear()
+            benchmark(client, sizes, measure)
+        results[benchmark.__name__] = measure.result()
+
+    if not args.only or "startup" in args.only:
+        results["startup"] = startup(args.startup_repeat)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the in-process benchmarks and compare them to the baseline."
+    )
+    parser.add_argument("--books", type=int, default=20000)
+    parser.add_argument("--collections", type=int, default=200)
+    parser.add_argument("--collection-size", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument(
+        "--startup-repeat", type=int, default=5, help="Processes started for startup"
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--update", action="store_true", help="Store the results as the new baseline"
+    )
+    parser.add_argument(
+        "--only", action="append", metavar="NAME", help="Run only this benchmark"
+    )
+    args = parser.parse_args(argv)
+    baseline_path = os.path.abspath(args.baseline)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Keeps the app.log of the run out of the working tree
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            results = run(args, directory)
+        finally:
+            os.chdir(cwd)
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+    for name, result in results.items():
+        expected = baseline.get(name, {})
+        print(
+            f"{name:28} {result['statements']:3} statements "
+            f"(baseline {expected.get('statements', '-')}) "
+            f"{result['time_ms']:9.3f} ms (baseline {expected.get('time_ms', '-')})"
+        )
+
+    if args.update:
+        baseline.update(results)
+        with open(baseline_path, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"Baseline written to {baseline_path}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,586 @@
+# load_testing.py
+#
+# HTTP load generator for a running server (python server.py or docker compose).
+#
+#   python -m testing.load_testing --seed-books 2000000 --seed-collections 5000
+#   python -m testing.load_testing --duration 60 --concurrency 32 --write-ratio 0.2 \
+#       --output run.json
+#
+# Seeding goes through the import endpoint and only has to be done once per
+# database. A run sends a weighted mix of read and write scenarios, covering
+# every route in resources/resources.py, from `concurrency` threads with one
+# keep-alive connection each, and prints (or writes) a JSON report with the
+# throughput and p50/p95/p99 latency overall and per scenario.
+#
+# Only the standard library is used, so it runs anywhere Python does. For
+# more load than one client process can generate, run several and add up
+# their reports.
+
+import argparse
+import http.client
+import json
+import math
+import random
+import sys
+import threading
+import time
+from urllib.parse import quote, urlencode, urlsplit
+
+
+FIRST_NAMES = """
+    Anna Jan Petr Eva Marie Tomas Lucie Martin Jana Pavel Karel Tereza Jakub
+    Alena David Hana Ondrej Klara Lukas Veronika John Mary James Linda Robert
+""".split()
+LAST_NAMES = """
+    Novak Svoboda Novotny Dvorak Cerny Prochazka Kucera Vesely Horak Nemec Marek
+    Pospisil Hajek Kral Jelinek Smith Johnson Williams Brown Jones Miller Davis
+""".split()
+TITLE_WORDS = """
+    history theory introduction systems data analysis modern principles network
+    design practice handbook science world language logic economics biology
+    physics chemistry war peace river night garden city memory light shadow
+    algorithms databases society culture art music philosophy
+""".split()
+BOOK_TYPES = ["fiction", "non-fiction"]
+
+# Hundreds of authors with a skewed popularity, like a real catalogue
+AUTHORS = [f"{first} {last}" for first in FIRST_NAMES for last in LAST_NAMES]
+AUTHOR_WEIGHTS = [1 / (rank + 1) for rank in range(len(AUTHORS))]
+
+
+def random_book(rng):
+    words = rng.sample(TITLE_WORDS, rng.randint(2, 5))
+    return {
+        "title": " ".join(words).capitalize(),
+        "author": rng.choices(AUTHORS, AUTHOR_WEIGHTS)[0],
+        "type": rng.choice(BOOK_TYPES),
+        "year": rng.randint(1900, 2024),
+    }
+
+
+class Client:
+    """One keep-alive connection, reopened after errors."""
+
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, content_type="application/json"):
+        """Return (status, parsed JSON body or None)."""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+        headers = {}
+        if body is not None:
+            if not isinstance(body, (str, bytes)):
+                body = json.dumps(body)
+            headers["Content-Type"] = content_type
+        try:
+            self.connection.request(method, self.prefix + path, body, headers)
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+        try:
+            return response.status, json.loads(data) if data else None
+        except ValueError:
+            return response.status, None
+
+
+def seed(base_url, books, collections, collection_size, batch_size, rng):
+    """Insert `books` books through the import endpoint, then `collections`."""
+    client = Client(base_url, timeout=600)
+    started = time.perf_counter()
+    inserted = 0
+    while inserted < books:
+        count = min(batch_size * 10, books - inserted)
+        body = "\n".join(json.dumps(random_book(rng)) for _ in range(count))
+        status, report = client.request(
+            "POST",
+            f"/books/books/import?batch_size={batch_size}",
+            body,
+            "application/x-ndjson",
+        )
+        if status != 200:
+            raise RuntimeError(f"Import failed with status {status}: {report}")
+        inserted += report["inserted"]
+        print(f"seeded {inserted}/{books} books", file=sys.stderr)
+
+    low, high = book_id_range(client)
+    for number in range(collections):
+        size = min(collection_size, high - low + 1)
+        status, _ = client.request(
+            "POST",
+            "/books/collections",
+            {
+                "name": f"Collection {number}",
+                "description": " ".join(rng.sample(TITLE_WORDS, 6)),
+                "book_ids": rng.sample(range(low, high + 1), size),
+            },
+        )
+        if status != 201:
+            raise RuntimeError(f"Creating a collection failed with status {status}")
+    print(f"seeded in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+
+
+def book_id_range(client):
+    """Lowest and highest book id, assuming ids are mostly contiguous."""
+    _, first = client.request("GET", "/books/books?limit=1")
+    if not first or not first.get("books"):
+        raise RuntimeError("There are no books, seed the database first")
+    low = first["books"][0]["id"]
+
+    def exists(book_id):
+        return client.request("GET", f"/books/books/{book_id}")[0] == 200
+
+    # Double the step while books exist, then bisect the last step
+    high, step = low, 1
+    while exists(high + step):
+        high += step
+        step *= 2
+    top = high + step
+    while top - high > 1:
+        middle = (high + top) // 2
+        if exists(middle):
+            high = middle
+        else:
+            top = middle
+    return low, high
+
+
+def collection_ids(client):
+    ids = []
+    after = None
+    while True:
+        query = "limit=100" + (f"&after={after}" if after else "")
+        _, page = client.request("GET", f"/books/collections?{query}")
+        ids += [collection["id"] for collection in page["collections"]]
+        after = page["next_cursor"]
+        if not after:
+            return ids
+
+
+class Worker:
+    """Runs scenarios on its own connection and keeps its own measurements."""
+
+    def __init__(self, base_url, books, collections, rng):
+        self.client = Client(base_url)
+        self.low, self.high = books
+        self.collections = collections
+        self.rng = rng
+        # Rows this worker created, deleted again by the delete scenarios
+        self.own_books = []
+        self.own_collections = []
+        # Filters and next cursor of every paginated listing being walked
+        self.walks = {}
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def book_id(self):
+        return self.rng.randint(self.low, self.high)
+
+    def collection_id(self):
+        return self.rng.choice(self.collections)
+
+    def walk(self, path, new_params):
+        """
+        Fetch the next page of the listing at `path`, with the filters of the
+        current walk; a walk starts over with new filters after its last page.
+        """
+        params, after = self.walks.get(path) or (new_params(), None)
+        query = {**params, "after": after} if after else params
+        status, body = self.client.request("GET", f"{path}?{urlencode(query)}")
+        after = body.get("next_cursor") if status == 200 and body else None
+        self.walks[path] = (params, after) if after else None
+        return status, body
+
+    # Read scenarios
+
+    def get_book(self):
+        return self.client.request("GET", f"/books/books/{self.book_id()}")
+
+    def list_books(self):
+        params = {"author": self.rng.choice(AUTHORS), "per_page": 20}
+        params["page"] = self.rng.randint(1, 3)
+        return self.client.request("GET", f"/books/books?{urlencode(params)}")
+
+    def cursor_books(self):
+        def filters():
+            params = {"book_type": self.rng.choice(BOOK_TYPES), "limit": 50}
+            params["year"] = self.rng.randint(1900, 2024)
+            return params
+
+        return self.walk("/books/books", filters)
+
+    def search_books(self):
+        query = quote(" ".join(self.rng.sample(TITLE_WORDS, 2)))
+        return self.client.request("GET", f"/books/books?q={query}&limit=20")
+
+    def batch_books(self):
+        ids = ",".join(str(self.book_id()) for _ in range(50))
+        return self.client.request("GET", f"/books/books/batch?ids={ids}")
+
+    def batch_books_post(self):
+        ids = [self.book_id() for _ in range(50)]
+        return self.client.request("POST", "/books/books/batch", {"ids": ids})
+
+    def export_books(self):
+        params = {"author": self.rng.choice(AUTHORS), "year": 2000}
+        return self.client.request("GET", f"/books/books/export?{urlencode(params)}")
+
+    def book_stats(self):
+        return self.client.request("GET", "/books/stats")
+
+    def find_duplicates(self):
+        book = random_book(self.rng)
+        params = {"title": book["title"], "author": book["author"]}
+        return self.client.request(
+            "GET", f"/books/books/duplicates?{urlencode(params)}"
+        )
+
+    def lookup_duplicates(self):
+        books = [random_book(self.rng) for _ in range(20)]
+        books = [{"title": b["title"], "author": b["author"]} for b in books]
+        return self.client.request(
+            "POST", "/books/books/duplicates", {"books": books}
+        )
+
+    def duplicate_report(self):
+        return self.walk("/books/books/duplicates/report", lambda: {"limit": 20})
+
+    def list_collections(self):
+        return self.walk("/books/collections", lambda: {"limit": 20})
+
+    def get_collection(self):
+        return self.client.request("GET", f"/books/collections/{self.collection_id()}")
+
+    def get_collection_expanded(self):
+        return self.client.request(
+            "GET", f"/books/collections/{self.collection_id()}?expand=books"
+        )
+
+    # Write scenarios
+
+    def create_book(self):
+        status, body = self.client.request(
+            "POST", "/books/books", random_book(self.rng)
+        )
+        if status == 201:
+            self.own_books.append(body["id"])
+        return status, body
+
+    def update_book(self):
+        if not self.own_books:
+            return self.create_book()
+        book_id = self.rng.choice(self.own_books)
+        return self.client.request(
+            "PUT", f"/books/books/{book_id}", random_book(self.rng)
+        )
+
+    def delete_book(self):
+        if not self.own_books:
+            return self.create_book()
+        return self.client.request("DELETE", f"/books/books/{self.own_books.pop()}")
+
+    def import_books(self):
+        body = "\n".join(json.dumps(random_book(self.rng)) for _ in range(100))
+        return self.client.request(
+            "POST", "/books/books/import", body, "application/x-ndjson"
+        )
+
+    def create_collection(self):
+        status, body = self.client.request(
+            "POST",
+            "/books/collections",
+            {
+                "name": "Load test",
+                "description": "Created by the load test",
+                "book_ids": [self.book_id() for _ in range(20)],
+            },
+        )
+        if status == 201:
+            self.own_collections.append(body["collection_id"])
+        return status, body
+
+    def patch_collection(self):
+        ids = [self.book_id() for _ in range(4)]
+        return self.client.request(
+            "PATCH",
+            f"/books/collections/{self.collection_id()}",
+            {"add": ids[:2], "remove": ids[2:]},
+        )
+
+    def update_collection(self):
+        if not self.own_collections:
+            return self.create_collection()
+        return self.client.request(
+            "PUT",
+            f"/books/collections/{self.rng.choice(self.own_collections)}",
+            {
+                "name": "Load test",
+                "description": "Updated by the load test",
+                "book_ids": [self.book_id() for _ in range(20)],
+            },
+        )
+
+    def delete_collection(self):
+        if not self.own_collections:
+            return self.create_collection()
+        collection_id = self.own_collections.pop()
+        return self.client.request("DELETE", f"/books/collections/{collection_id}")
+
+    def run(self, name, scenario):
+        started = time.perf_counter()
+        try:
+            status, _ = scenario()
+        except Exception as e:
+            kind = type(e).__name__
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            status = "error"
+        elapsed = time.perf_counter() - started
+        self.latencies.setdefault(name, []).append(elapsed)
+        statuses = self.statuses.setdefault(name, {})
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def cleanup(self):
+        for book_id in self.own_books:
+            self.client.request("DELETE", f"/books/books/{book_id}")
+        for collection_id in self.own_collections:
+            self.client.request("DELETE", f"/books/collections/{collection_id}")
+
+
+# Relative weights inside the read and the write part of the mix
+READ_SCENARIOS = {
+    "get_book": 30,
+    "list_books": 15,
+    "cursor_books": 10,
+    "search_books": 10,
+    "batch_books": 5,
+    "batch_books_post": 3,
+    "export_books": 2,
+    "book_stats": 2,
+    "find_duplicates": 3,
+    "lookup_duplicates": 1,
+    "duplicate_report": 1,
+    "list_collections": 8,
+    "get_collection": 15,
+    "get_collection_expanded": 5,
+}
+WRITE_SCENARIOS = {
+    "create_book": 30,
+    "update_book": 25,
+    "delete_book": 15,
+    "import_books": 2,
+    "create_collection": 5,
+    "patch_collection": 15,
+    "update_collection": 5,
+    "delete_collection": 3,
+}
+
+
+def scenario_weights(write_ratio, overrides):
+    weights = {}
+    for scenarios, share in (
+        (READ_SCENARIOS, 1 - write_ratio),
+        (WRITE_SCENARIOS, write_ratio),
+    ):
+        total = sum(scenarios.values())
+        for name, weight in scenarios.items():
+            weights[name] = share * weight / total
+    for item in overrides or []:
+        name, _, weight = item.partition("=")
+        if name not in weights:
+            raise SystemExit(f"Unknown scenario {name}")
+        weights[name] = float(weight)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    # Rounded first, so float error like 0.1 * 30 = 3.0000000000000004
+    # doesn't push the rank up by one
+    rank = math.ceil(round(fraction * len(sorted_values), 9))
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def summarize(latencies, duration, statuses=None):
+    values = sorted(latencies)
+    summary = {
+        "requests": len(values),
+        "throughput": round(len(values) / duration, 2),
+        "mean_ms": round(1000 * sum(values) / len(values), 3) if values else None,
+    }
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        value = percentile(values, fraction)
+        summary[f"{name}_ms"] = round(1000 * value, 3) if value is not None else None
+    summary["max_ms"] = round(1000 * values[-1], 3) if values else None
+    if statuses is not None:
+        summary["statuses"] = statuses
+    return summary
+
+
+def run_load(args):
+    setup = Client(args.url)
+    books = book_id_range(setup)
+    collections = collection_ids(setup)
+    if not collections:
+        raise SystemExit("There are no collections, seed the database first")
+    weights = scenario_weights(args.write_ratio, args.scenario)
+    names = list(weights)
+
+    workers = [
+        Worker(args.url, books, collections, random.Random(args.random_seed + i))
+        for i in range(args.concurrency)
+    ]
+    deadline = time.perf_counter() + args.warmup + args.duration
+    measure_from = time.perf_counter() + args.warmup
+
+    def loop(worker):
+        while time.perf_counter() < deadline:
+            name = worker.rng.choices(names, [weights[n] for n in names])[0]
+            if time.perf_counter() < measure_from:
+                # Warm-up requests fill caches and pools but aren't counted
+                try:
+                    getattr(worker, name)()
+                except Exception:
+                    pass
+                continue
+            worker.run(name, getattr(worker, name))
+
+    threads = [threading.Thread(target=loop, args=(w,)) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = args.duration
+
+    report = {
+        "config": {
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "write_ratio": args.write_ratio,
+            "books": books[1] - books[0] + 1,
+            "collections": len(collections),
+            "weights": {name: round(weight, 4) for name, weight in weights.items()},
+        },
+        "errors": {},
+        "scenarios": {},
+    }
+    every = []
+    for name in names:
+        latencies = [v for w in workers for v in w.latencies.get(name, [])]
+        statuses = {}
+        for worker in workers:
+            for status, count in worker.statuses.get(name, {}).items():
+                statuses[status] = statuses.get(status, 0) + count
+        every += latencies
+        report["scenarios"][name] = summarize(latencies, duration, statuses)
+    for worker in workers:
+        for kind, count in worker.errors.items():
+            report["errors"][kind] = report["errors"].get(kind, 0) + count
+    report["total"] = summarize(every, duration)
+
+    if not args.keep_writes:
+        for worker in workers:
+            worker.cleanup()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Seed the database and measure throughput and latency."
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument(
+        "--seed-books",
+        type=int,
+        default=0,
+        help="Insert this many books before the run",
+    )
+    parser.add_argument(
+        "--seed-collections",
+        type=int,
+        default=0,
+        help="Create this many collections before the run",
+    )
+    parser.add_argument(
+        "--collection-size", type=int, default=50, help="Books per seeded collection"
+    )
+    parser.add_argument(
+        "--seed-batch-size",
+        type=int,
+        default=5000,
+        help="batch_size passed to the import endpoint",
+    )
+    parser.add_argument(
+        "--seed-only",
+        action="store_true",
+        help="Seed and exit without running the load",
+    )
+    parser.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    parser.add_argument(
+        "--warmup",
+        type=float,
+        default=5,
+        help="Unmeasured seconds before the measurement",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Concurrent client connections"
+    )
+    parser.add_argument(
+        "--write-ratio",
+        type=float,
+        default=0.1,
+        help="Share of requests that write, 0 to 1",
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        metavar="NAME=WEIGHT",
+        help="Override the weight of one scenario, 0 disables it",
+    )
+    parser.add_argument("--random-seed", type=int, default=1)
+    parser.add_argument(
+        "--keep-writes",
+        action="store_true",
+        help="Keep the books and collections the run created "
+        "(imported books are always kept)",
+    )
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.random_seed)
+    if args.seed_books or args.seed_collections:
+        seed(
+            args.url,
+            args.seed_books,
+            args.seed_collections,
+            args.collection_size,
+            args.seed_batch_size,
+            rng,
+        )
+    if args.seed_only:
+        return
+
+    report = run_load(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
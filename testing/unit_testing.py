@@ -1,9 +1,56 @@
 # unit_testing.py
 
+import json
+import logging
+import os
+import signal
+import tempfile
+import time
 import unittest
+from contextlib import contextmanager
+from unittest import mock
 
-from app import app
+from app import create_app
+from db.booktypes import booktypes
+from db.models import db, Book, BookType
+from resources.api import api as books_api
+from resources.book import book_model, serialize_book
+from resources.booklist import book_cursor_list_model, book_list_model
+from resources.booklist import serialize_book_cursor_list, serialize_book_list
+from db.migrations import MIGRATIONS, initialize, upgrade
+from utils.metrics import metrics
+from utils.request_log import AsyncLogHandler
+from utils.cache import BookSearchCache, LocalCache, SharedCache, book_search_cache
+from werkzeug.datastructures import MultiDict
+from db.db_init import engine_options, replica_binds
+from db.routing import PRIMARY_COOKIE
+from flask import Flask, g
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from utils.utils import is_integer
+from utils.pagination import decode_cursor, encode_cursor
+from testing.benchmarks import compare
+from testing.load_testing import percentile
+
+
+app = create_app()
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements executed inside the block."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
 
 
 class TestUtils(unittest.TestCase):
@@ -16,6 +63,15 @@ class TestUtils(unittest.TestCase):
     def test_is_integer_invalid(self):
         self.assertFalse(is_integer("abc"))
 
+    def test_is_integer_fraction(self):
+        self.assertFalse(is_integer(12.5))
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(42)), 42)
+
+    def test_cursor_invalid(self):
+        self.assertIsNone(decode_cursor("not a cursor"))
+
 
 class BookApiTest(unittest.TestCase):
     def setUp(self):
@@ -38,6 +94,14 @@ class BookApiTest(unittest.TestCase):
         self.assertEqual(response.status_code, 201)
         self.app.delete(f"/books/books/{response.json['id']}")
 
+    def test_post_book_invalid_type(self):
+        book_data = {"title": "Test Book", "author": "Author", "year": 2021}
+        for book_type in [1, ["fiction"]]:
+            response = self.app.post(
+                "/books/books", json={**book_data, "type": book_type}
+            )
+            self.assertEqual(response.status_code, 400, book_type)
+
     def test_get_book_by_author(self):
         # Insert a mock book
         mock_book_data = {
@@ -58,6 +122,13 @@ class BookApiTest(unittest.TestCase):
         response = self.app.get("/books/books?year=abcd")
         self.assertEqual(response.status_code, 400)
 
+    def test_list_books_invalid_page(self):
+        for query in ["per_page=0", "per_page=-5", "per_page=101", "page=0"]:
+            response = self.app.get(f"/books/books?{query}")
+            self.assertEqual(response.status_code, 400, query)
+        response = self.app.get("/books/collections?page=0")
+        self.assertEqual(response.status_code, 400)
+
     def test_update_book(self):
         # First, insert a book to update
         book_data = {
@@ -99,6 +170,866 @@ class BookApiTest(unittest.TestCase):
         response = self.app.delete("/books/books/999")
         self.assertEqual(response.status_code, 404)
 
+    def test_get_books_with_cursor(self):
+        book_data = {
+            "title": "Cursor Book",
+            "author": "Cursor Author",
+            "type": "fiction",
+            "year": 2020,
+        }
+        ids = [
+            self.app.post("/books/books", json=book_data).json["id"]
+            for _ in range(3)
+        ]
+
+        # Walk all pages and collect the ids
+        seen = []
+        url = "/books/books?author=Cursor Author&limit=2"
+        response = self.app.get(url)
+        self.assertEqual(response.status_code, 200)
+        seen += [book["id"] for book in response.json["books"]]
+        next_cursor = response.json["next_cursor"]
+        self.assertIsNotNone(next_cursor)
+        response = self.app.get(f"{url}&after={next_cursor}")
+        self.assertEqual(response.status_code, 200)
+        seen += [book["id"] for book in response.json["books"]]
+        self.assertIsNone(response.json["next_cursor"])
+        self.assertEqual(seen, ids)
+
+        for book_id in ids:
+            self.app.delete(f"/books/books/{book_id}")
+
+    def test_import_books_ndjson(self):
+        book = {"title": "Bulk", "author": "Bulk Author", "year": 2001}
+        body = "\n".join(
+            [
+                json.dumps({**book, "type": "fiction"}),
+                json.dumps({**book, "type": "poetry"}),
+                "not json",
+                json.dumps({**book, "type": "non-fiction"}),
+                json.dumps({**book, "type": ["fiction"]}),
+                json.dumps({**book, "type": "fiction", "year": 2001.5}),
+            ]
+        )
+        body = body.encode() + b'\n{"title": "Bulk \xff"}'
+        response = self.app.post(
+            "/books/books/import?batch_size=1",
+            data=body,
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["inserted"], 2)
+        self.assertEqual(response.json["failed"], 5)
+        self.assertEqual(
+            [error["row"] for error in response.json["errors"]], [2, 3, 5, 6, 7]
+        )
+        self.assertEqual(response.json["errors"][3]["error"], "Year is not an integer")
+        self.assertEqual(response.json["errors"][4]["error"], "Row is not valid UTF-8")
+
+        response = self.app.get("/books/books?author=Bulk Author&limit=10")
+        self.assertEqual(len(response.json["books"]), 2)
+        for book in response.json["books"]:
+            self.app.delete(f"/books/books/{book['id']}")
+
+    def test_import_books_csv(self):
+        body = (
+            "title,author,type,year\n"
+            "Csv 1,Csv Author,fiction,1999\n"
+            "Csv 2,Csv Author,fiction,19999\n"
+        ).encode() + b"Csv \xff,Csv Author,fiction,1999\n"
+        response = self.app.post(
+            "/books/books/import", data=body, content_type="text/csv"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["inserted"], 1)
+        self.assertEqual(
+            response.json["errors"],
+            [
+                {"row": 2, "error": "Year is too long"},
+                {"row": 3, "error": "Row is not valid UTF-8"},
+            ],
+        )
+
+        response = self.app.get("/books/books?author=Csv Author&limit=10")
+        for book in response.json["books"]:
+            self.app.delete(f"/books/books/{book['id']}")
+
+    def test_export_books(self):
+        book_data = {
+            "title": "Export, Book",
+            "author": "Export Author",
+            "type": "non-fiction",
+            "year": 1990,
+        }
+        book_id = self.app.post("/books/books", json=book_data).json["id"]
+
+        response = self.app.get("/books/books/export?author=Export Author")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [json.loads(line) for line in response.data.decode().splitlines()],
+            [{"id": book_id, **book_data}],
+        )
+
+        response = self.app.get("/books/books/export?author=Export Author&format=csv")
+        self.assertEqual(
+            response.data.decode().splitlines(),
+            [
+                "id,title,author,type,year",
+                f'{book_id},"Export, Book",Export Author,non-fiction,1990',
+            ],
+        )
+
+        self.app.delete(f"/books/books/{book_id}")
+
+    def test_get_books_by_ids(self):
+        book_data = {"title": "Batch", "author": "Author", "type": "fiction", "year": 1}
+        ids = [
+            self.app.post("/books/books", json=book_data).json["id"] for _ in range(3)
+        ]
+        requested = [ids[2], 99999, ids[0], ids[2]]
+
+        with count_queries() as statements:
+            response = self.app.get(
+                "/books/books/batch?ids=" + ",".join(map(str, requested))
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 2)
+        returned = [book["id"] for book in response.json["books"]]
+        self.assertEqual(returned, [ids[2], ids[0]])
+        self.assertEqual(response.json["missing"], [99999])
+
+        response = self.app.post("/books/books/batch", json={"ids": requested})
+        returned = [book["id"] for book in response.json["books"]]
+        self.assertEqual(returned, [ids[2], ids[0]])
+        self.assertIsNone(response.headers.get("Set-Cookie"))
+
+        response = self.app.get("/books/books/batch?ids=1,abc")
+        self.assertEqual(response.status_code, 400)
+
+        for book_id in ids:
+            self.app.delete(f"/books/books/{book_id}")
+
+    def test_get_books_by_ids_out_of_range(self):
+        response = self.app.get("/books/books/batch?ids=1,99999999999999999999999")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["error"], "ids must be positive integers")
+        for ids in [[True], [-1], [2**63]]:
+            response = self.app.post("/books/books/batch", json={"ids": ids})
+            self.assertEqual(response.status_code, 400, ids)
+
+    def test_search_books(self):
+        ids = [
+            self.app.post("/books/books", json=book_data).json["id"]
+            for book_data in [
+                {
+                    "title": "Quantum Gardening",
+                    "author": "Searchable Writer",
+                    "type": "non-fiction",
+                    "year": 2011,
+                },
+                {
+                    "title": "Gardening for Quantum Physicists",
+                    "author": "Other Writer",
+                    "type": "non-fiction",
+                    "year": 2012,
+                },
+            ]
+        ]
+
+        response = self.app.get("/books/books?q=quantum gardening")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(book["id"] for book in response.json["books"]), sorted(ids)
+        )
+        response = self.app.get("/books/books?q=searchable quantum")
+        self.assertEqual([book["id"] for book in response.json["books"]], ids[:1])
+
+        # The index follows updates and deletes
+        self.app.put(
+            f"/books/books/{ids[0]}",
+            json={
+                "title": "Renamed",
+                "author": "Searchable Writer",
+                "type": "fiction",
+                "year": 2011,
+            },
+        )
+        self.app.delete(f"/books/books/{ids[1]}")
+        response = self.app.get("/books/books?q=quantum")
+        self.assertEqual(response.status_code, 404)
+
+        self.app.delete(f"/books/books/{ids[0]}")
+
+    def test_list_books_single_query(self):
+        book_data = {
+            "title": "Counted Book",
+            "author": "Counted Author",
+            "type": "non-fiction",
+            "year": 2005,
+        }
+        ids = [
+            self.app.post("/books/books", json=book_data).json["id"]
+            for _ in range(50)
+        ]
+
+        with count_queries() as statements:
+            response = self.app.get("/books/books?author=Counted Author&limit=50")
+        self.assertEqual(len(response.json["books"]), 50)
+        self.assertEqual(response.json["books"][0]["type"], "non-fiction")
+        # The page itself plus the table version lookup for the ETag
+        self.assertEqual(len(statements), 2)
+
+        for book_id in ids:
+            self.app.delete(f"/books/books/{book_id}")
+
+    def test_list_books_with_facets(self):
+        book = {"title": "Facet", "author": "Facet Author", "type": "fiction"}
+        ids = [
+            self.app.post("/books/books", json={**book, **change}).json["id"]
+            for change in [
+                {"year": 1991},
+                {"year": 1999, "type": "non-fiction"},
+                {"year": 2003},
+            ]
+        ]
+
+        url = "/books/books?author=Facet Author&per_page=1&facets=type,year,author"
+        with count_queries() as statements:
+            response = self.app.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["books"]), 1)
+        facets = response.json["facets"]
+        self.assertEqual(
+            facets["type"],
+            [{"type": "fiction", "count": 2}, {"type": "non-fiction", "count": 1}],
+        )
+        self.assertEqual(
+            facets["year"],
+            [
+                {"from": 1990, "to": 1999, "count": 2},
+                {"from": 2000, "to": 2009, "count": 1},
+            ],
+        )
+        self.assertEqual(facets["author"], [{"author": "Facet Author", "count": 3}])
+        # ETag version, count and page, then all facets in one grouped query
+        self.assertEqual(len(statements), 4)
+
+        response = self.app.get("/books/books?facets=type,year,author&limit=1")
+        all_books = sum(row["count"] for row in response.json["facets"]["type"])
+        self.assertEqual(
+            all_books, sum(row["count"] for row in response.json["facets"]["year"])
+        )
+        self.assertGreaterEqual(all_books, 3)
+
+        response = self.app.get("/books/books?facets=publisher")
+        self.assertEqual(response.status_code, 400)
+
+        for book_id in ids:
+            self.app.delete(f"/books/books/{book_id}")
+
+    def test_list_books_total_modes(self):
+        book_data = {
+            "title": "Total Book",
+            "author": "Total Author",
+            "type": "fiction",
+            "year": 2010,
+        }
+        ids = [
+            self.app.post("/books/books", json=book_data).json["id"]
+            for _ in range(3)
+        ]
+        url = "/books/books?author=Total Author&per_page=2"
+
+        response = self.app.get(url)
+        self.assertEqual(response.json["total"], 3)
+        self.assertEqual(response.json["pages"], 2)
+        self.assertEqual(response.json["total_mode"], "exact")
+
+        # No COUNT(*), only the ETag version and the page
+        with count_queries() as statements:
+            response = self.app.get(url + "&total=none")
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(len(response.json["books"]), 2)
+        self.assertIsNone(response.json["total"])
+        self.assertIsNone(response.json["pages"])
+
+        # Planner estimates are Postgres only
+        response = self.app.get(url + "&total=estimated")
+        self.assertEqual(response.json["total_mode"], "exact")
+
+        response = self.app.get(url + "&total=cached")
+        self.assertEqual(response.json["total"], 3)
+        self.assertEqual(response.json["total_mode"], "cached")
+        ids.append(self.app.post("/books/books", json=book_data).json["id"])
+        # Other pages of the same filters reuse the total until it expires
+        with count_queries() as statements:
+            response = self.app.get(url + "&total=cached&page=2")
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(response.json["total"], 3)
+        self.assertEqual(self.app.get(url).json["total"], 4)
+
+        response = self.app.get(url + "&total=approximately")
+        self.assertEqual(response.status_code, 400)
+
+        for book_id in ids:
+            self.app.delete(f"/books/books/{book_id}")
+
+    def test_near_duplicates(self):
+        book = {
+            "title": "Duplicated Sources Handbook",
+            "author": "Dupe, Anna",
+            "type": "non-fiction",
+            "year": 2011,
+        }
+        book_id = self.app.post("/books/books", json=book).json["id"]
+        typo = {**book, "title": "Duplicated Sorces Handbok", "author": "Anna Dupe"}
+
+        response = self.app.get(
+            "/books/books/duplicates",
+            query_string={"title": typo["title"], "author": typo["author"]},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [duplicate["book"]["id"] for duplicate in response.json["duplicates"]],
+            [book_id],
+        )
+        self.assertGreaterEqual(response.json["duplicates"][0]["score"], 0.85)
+
+        response = self.app.post(
+            "/books/books?check_duplicates=true",
+            json={**book, "title": "Unrelated Title", "author": "Other Author"},
+        )
+        self.assertEqual(response.status_code, 201)
+        other_id = response.json["id"]
+        response = self.app.post("/books/books?check_duplicates=true", json=typo)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json["duplicates"][0]["book"]["id"], book_id)
+
+        rows = [
+            typo,
+            {**book, "title": "A Fresh Book"},
+            {**book, "title": "A Fresh Bok"},
+        ]
+        body = "\n".join(json.dumps(row) for row in rows)
+        response = self.app.post(
+            "/books/books/import?check_duplicates=true",
+            data=body,
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(response.json["inserted"], 1)
+        self.assertEqual(
+            response.json["errors"],
+            [
+                {"row": 1, "error": "Book may already exist", "duplicates": [book_id]},
+                {"row": 3, "error": "Book may repeat row 2"},
+            ],
+        )
+
+        # Without the check the typo is added, then the report groups both
+        typo_id = self.app.post("/books/books", json=typo).json["id"]
+        groups = []
+        url = "/books/books/duplicates/report?limit=2"
+        while url:
+            response = self.app.get(url)
+            groups += response.json["groups"]
+            cursor = response.json["next_cursor"]
+            url = cursor and f"/books/books/duplicates/report?limit=2&after={cursor}"
+        self.assertIn(
+            {book_id, typo_id},
+            [{book["id"] for book in group["books"]} for group in groups],
+        )
+
+        response = self.app.get("/books/books?title=A Fresh Book")
+        for book_id in [book_id, other_id, typo_id, response.json["books"][0]["id"]]:
+            self.app.delete(f"/books/books/{book_id}")
+
+    def test_near_duplicates_crowded_key(self):
+        # Hundreds of books share the title key of the duplicate
+        with app.app_context():
+            crowd = [
+                Book(
+                    title=f"Introduction to Algebra {n}",
+                    author=f"Author {n}",
+                    type_id=booktypes.id_for("non-fiction"),
+                    year=2000,
+                )
+                for n in range(300)
+            ]
+            db.session.add_all(crowd)
+            db.session.commit()
+            crowd_ids = [book.id for book in crowd]
+        book = {
+            "title": "Introduction to Algorithms",
+            "author": "Thomas Cormen",
+            "type": "non-fiction",
+            "year": 2009,
+        }
+        book_id = self.app.post("/books/books", json=book).json["id"]
+
+        typo = {**book, "title": "Introducton to Algoritms"}
+        response = self.app.post("/books/books?check_duplicates=true", json=typo)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json["duplicates"][0]["book"]["id"], book_id)
+
+        crowded = {"title": "Introduction to Algebra 7", "author": ""}
+        response = self.app.post(
+            "/books/books/duplicates", json={"books": [typo, crowded]}
+        )
+        self.assertEqual(response.json["duplicates"][0][0]["book"]["id"], book_id)
+
+        self.app.delete(f"/books/books/{book_id}")
+        with app.app_context():
+            Book.query.filter(Book.id.in_(crowd_ids)).delete()
+            db.session.commit()
+
+    def test_get_book_not_modified(self):
+        book_data = {
+            "title": "Etag Book",
+            "author": "Etag Author",
+            "type": "fiction",
+            "year": 2015,
+        }
+        book_id = self.app.post("/books/books", json=book_data).json["id"]
+
+        response = self.app.get(f"/books/books/{book_id}")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        response = self.app.get(
+            f"/books/books/{book_id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+        self.app.put(f"/books/books/{book_id}", json={**book_data, "year": 2016})
+        response = self.app.get(
+            f"/books/books/{book_id}", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["year"], 2016)
+
+        self.app.delete(f"/books/books/{book_id}")
+
+    def test_concurrent_updates_both_bump_version(self):
+        book_data = {
+            "title": "Version Book",
+            "author": "Version Author",
+            "type": "fiction",
+            "year": 2015,
+        }
+        book_id = self.app.post("/books/books", json=book_data).json["id"]
+
+        with app.app_context():
+            book = db.session.get(Book, book_id)
+            version = book.version
+            # Another writer commits between the read and this flush
+            with db.engine.begin() as connection:
+                connection.execute(
+                    Book.__table__.update()
+                    .where(Book.id == book_id)
+                    .values(version=Book.version + 1)
+                )
+            book.year = 2016
+            db.session.commit()
+            self.assertEqual(book.version, version + 2)
+
+        self.app.delete(f"/books/books/{book_id}")
+
+    def test_list_books_not_modified(self):
+        book_data = {
+            "title": "Etag Book",
+            "author": "Etag List Author",
+            "type": "fiction",
+            "year": 2015,
+        }
+        book_id = self.app.post("/books/books", json=book_data).json["id"]
+        url = "/books/books?author=Etag List Author"
+
+        etag = self.app.get(url).headers["ETag"]
+        with count_queries() as statements:
+            response = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+
+        # Any write to the table invalidates the list ETag
+        other_id = self.app.post("/books/books", json=book_data).json["id"]
+        response = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["books"]), 2)
+
+        self.app.delete(f"/books/books/{book_id}")
+        self.app.delete(f"/books/books/{other_id}")
+
+    def test_get_books_invalid_cursor(self):
+        response = self.app.get("/books/books?after=garbage&limit=2")
+        self.assertEqual(response.status_code, 400)
+
+
+class SerializerTest(unittest.TestCase):
+    def test_same_output_as_marshal(self):
+        with app.app_context():
+            fiction_id = booktypes.id_for("fiction")
+            books = [
+                Book(id=1, title="A", author="B", type_id=fiction_id, year=2000),
+                Book(id=2, title=None, author="C", type_id=None, year="1999"),
+            ]
+            data = {"books": books, "total": 2, "pages": 1, "page": 1}
+            self.assertEqual(
+                json.dumps(serialize_book_list(data)),
+                json.dumps(books_api.marshal(data, book_list_model)),
+            )
+            cursor_data = {"books": books, "next_cursor": None}
+            self.assertEqual(
+                json.dumps(serialize_book_cursor_list(cursor_data)),
+                json.dumps(books_api.marshal(cursor_data, book_cursor_list_model)),
+            )
+            self.assertEqual(
+                json.dumps(serialize_book(books)),
+                json.dumps(books_api.marshal(books, book_model)),
+            )
+
+
+class BookTypeRegistryTest(unittest.TestCase):
+    def test_lookup(self):
+        with app.app_context():
+            fiction_id = booktypes.id_for("fiction")
+            self.assertEqual(booktypes.name_for(fiction_id), "fiction")
+            self.assertIsNone(booktypes.id_for("poetry"))
+
+    def test_invalidated_on_insert(self):
+        with app.app_context():
+            self.assertIsNone(booktypes.id_for("poetry"))
+            poetry = BookType(name="poetry")
+            db.session.add(poetry)
+            db.session.commit()
+            self.assertEqual(booktypes.id_for("poetry"), poetry.id)
+            db.session.delete(poetry)
+            db.session.commit()
+            self.assertIsNone(booktypes.id_for("poetry"))
+
+    def test_filter_by_type(self):
+        client = app.test_client()
+        response = client.get("/books/books?book_type=poetry")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json["error"], 'Type must be "fiction" or "non-fiction"'
+        )
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        metrics.reset()
+
+    def test_metrics_per_route(self):
+        self.app.get("/books/books/99999")
+        self.app.get("/books/books/99999")
+
+        response = self.app.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode()
+        labels = (
+            f'route="/books/books/<int:book_id>",method="GET",worker="{os.getpid()}"'
+        )
+        self.assertIn(f"http_request_duration_seconds_count{{{labels}}} 2", body)
+        self.assertIn(f"db_statements_total{{{labels}}} 2", body)
+        self.assertNotIn('route="/metrics"', body)
+
+
+class FakeRedis:
+    """Stand-in for the shared cache server."""
+
+    def __init__(self):
+        self.data = {}
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value.encode()
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_local_cache_bounds(self):
+        cache = LocalCache(max_entries=2, max_bytes=10, ttl=30)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get_many(["a"])
+        cache.set("c", "3")
+        # "b" was the least recently used entry
+        self.assertEqual(cache.get_many(["a", "b", "c"]), ["1", None, "3"])
+        # Over the byte limit, the oldest entry "a" goes
+        cache.set("d", "x" * 8)
+        self.assertEqual(cache.get_many(["a", "c", "d"]), [None, "3", "x" * 8])
+        self.assertEqual(cache.evictions, 2)
+
+        cache = LocalCache(ttl=-1)
+        cache.set("a", "1")
+        self.assertEqual(cache.get_many(["a"]), [None])
+
+    def test_shared_cache_invalidation(self):
+        cache = BookSearchCache(SharedCache(FakeRedis()))
+        by_kim = MultiDict({"author": "Kim", "page": "1"})
+        by_year = MultiDict({"year": "2019"})
+        cache.set(cache.key(by_kim), {"books": []}, 200)
+        cache.set(cache.key(by_year), {"books": []}, 200)
+
+        cache.invalidate(
+            [{"author": "Lee", "title": "T", "year": "2019", "book_type": "fiction"}]
+        )
+        self.assertEqual(cache.get(cache.key(by_kim)), [{"books": []}, 200])
+        self.assertIsNone(cache.get(cache.key(by_year)))
+
+    def test_search_cache_invalidated_by_writes(self):
+        client = app.test_client()
+        # Reads from a client without the primary cookie the writes set
+        reader = app.test_client()
+        book_data = {
+            "title": "Cached Book",
+            "author": "Cached Author",
+            "type": "fiction",
+            "year": 2018,
+        }
+        book_id = client.post("/books/books", json=book_data).json["id"]
+        url = "/books/books?author=Cached Author"
+
+        reader.get(url)
+        hits = book_search_cache.hits
+        reader.get(url)
+        self.assertEqual(book_search_cache.hits, hits + 1)
+        # The writer is pinned to the primary and skips the cache
+        client.get(url)
+        self.assertEqual(book_search_cache.hits, hits + 1)
+
+        # A book by someone else can't change this search
+        other_id = client.post(
+            "/books/books", json={**book_data, "author": "Someone Else"}
+        ).json["id"]
+        reader.get(url)
+        self.assertEqual(book_search_cache.hits, hits + 2)
+
+        # Moving the book away from the author invalidates it
+        client.put(
+            f"/books/books/{book_id}", json={**book_data, "author": "Moved Author"}
+        )
+        response = reader.get(url)
+        self.assertEqual(book_search_cache.hits, hits + 2)
+        self.assertEqual(response.status_code, 404)
+
+        client.delete(f"/books/books/{book_id}")
+        client.delete(f"/books/books/{other_id}")
+
+
+class EngineOptionsTest(unittest.TestCase):
+    def test_pool_options_from_environment(self):
+        environment = {"DB_POOL_SIZE": "3", "DB_STATEMENT_TIMEOUT": "2000"}
+        with mock.patch.dict(os.environ, environment):
+            options = engine_options("postgresql://user@localhost/books")
+        self.assertEqual(options["pool_size"], 3)
+        self.assertEqual(
+            options["connect_args"], {"options": "-c statement_timeout=2000"}
+        )
+        self.assertNotIn("pool_size", engine_options("sqlite://"))
+
+    def test_pool_exhausted_returns_503(self):
+        client = app.test_client()
+        with mock.patch.object(
+            db.session, "query", side_effect=PoolTimeoutError("pool exhausted")
+        ):
+            response = client.get("/books/books/1")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers["Retry-After"], "1")
+
+    def test_pool_exhausted_on_write_returns_503(self):
+        client = app.test_client()
+        book = {"title": "Busy", "author": "Busy Author", "type": "fiction"}
+        collection = {"name": "Busy", "description": "Busy collection"}
+        exhausted = PoolTimeoutError("pool exhausted")
+        with mock.patch.object(db.session, "commit", side_effect=exhausted):
+            responses = [
+                client.post("/books/books", json={**book, "year": 2001}),
+                client.post("/books/collections", json=collection),
+            ]
+        with mock.patch(
+            "resources.bookcollection.touch_collection", side_effect=exhausted
+        ):
+            responses.append(
+                client.patch("/books/collections/1", json={"add": [1]})
+            )
+        self.assertEqual([response.status_code for response in responses], [503] * 3)
+
+    def test_pool_exhausted_during_import_returns_503(self):
+        client = app.test_client()
+        body = json.dumps(
+            {"title": "Busy", "author": "Busy Import", "type": "fiction", "year": 1}
+        )
+        exhausted = PoolTimeoutError("pool exhausted")
+        with mock.patch.object(db.session, "commit", side_effect=exhausted):
+            response = client.post(
+                "/books/books/import", data=body, content_type="application/x-ndjson"
+            )
+        self.assertEqual(response.status_code, 503)
+        with mock.patch(
+            "resources.bookimport.find_duplicates", side_effect=exhausted
+        ):
+            response = client.post(
+                "/books/books/import?check_duplicates=true",
+                data=body,
+                content_type="application/x-ndjson",
+            )
+        self.assertEqual(response.status_code, 503)
+        response = client.get("/books/books?author=Busy Import")
+        self.assertEqual(response.status_code, 404)
+
+
+class ReplicaRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        self.app.config["SQLALCHEMY_BINDS"] = replica_binds("sqlite://")
+        db.init_app(self.app)
+
+    def bind(self, **request_options):
+        with self.app.test_request_context(**request_options):
+            g.db_read_only = request_options.get("method", "GET") == "GET"
+            bind = db.session.get_bind()
+            db.session.remove()
+            return bind, db.engines
+
+    def test_reads_go_to_replica(self):
+        bind, engines = self.bind()
+        self.assertIs(bind, engines["replica_0"])
+
+    def test_writes_go_to_primary(self):
+        bind, engines = self.bind(method="POST")
+        self.assertIs(bind, engines[None])
+
+    def test_reads_after_write_go_to_primary(self):
+        cookie = f"{PRIMARY_COOKIE}={time.time() + 5}"
+        bind, engines = self.bind(headers={"Cookie": cookie})
+        self.assertIs(bind, engines[None])
+
+    def test_one_replica_per_request(self):
+        replicas = Flask(__name__)
+        replicas.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+        replicas.config["SQLALCHEMY_BINDS"] = replica_binds("sqlite://,sqlite://")
+        db.init_app(replicas)
+        with replicas.test_request_context():
+            g.db_read_only = True
+            binds = {db.session.get_bind() for _ in range(20)}
+            primary = db.engines[None]
+            db.session.remove()
+        self.assertEqual(len(binds), 1)
+        self.assertNotIn(primary, binds)
+
+    def test_successful_write_sets_primary_cookie(self):
+        client = app.test_client()
+        response = client.post("/books/books", json={"title": 1})
+        self.assertIsNone(response.headers.get("Set-Cookie"))
+
+        book = {"title": "Sticky", "author": "Author", "type": "fiction", "year": 2001}
+        response = client.post("/books/books", json=book)
+        self.assertIn(PRIMARY_COOKIE, response.headers["Set-Cookie"])
+        client.delete(f"/books/books/{response.json['id']}")
+
+
+class RequestLogTest(unittest.TestCase):
+    def test_requests_are_logged_as_json(self):
+        client = app.test_client()
+        handler = app.extensions["request_log"]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "test.log")
+            # Closed, the handler opens LOG_FILE again on the next record
+            handler.close()
+            try:
+                with mock.patch.dict(os.environ, {"LOG_FILE": path}):
+                    client.get("/books/books/99999")
+                    app.logger.error("Failed to insert book! boom")
+                    handler.flush()
+                with open(path) as file:
+                    records = [json.loads(line) for line in file.readlines()[-2:]]
+            finally:
+                handler.close()
+        self.assertEqual(records[0]["route"], "/books/books/<int:book_id>")
+        self.assertEqual(records[0]["status"], 404)
+        self.assertEqual(records[0]["queries"], 1)
+        self.assertIn("latency_ms", records[0])
+        self.assertEqual(records[1]["level"], "ERROR")
+        self.assertEqual(records[1]["message"], "Failed to insert book! boom")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_forked_child_can_log_while_parent_holds_lock(self):
+        handler = AsyncLogHandler(make_handler=logging.NullHandler)
+        with handler._lock:
+            pid = os.fork()
+            if pid == 0:
+                # A deadlock here would hang the test instead of failing it
+                signal.alarm(5)
+                handler.handle(logging.makeLogRecord({"msg": "child"}))
+                handler.close()
+                os._exit(0)
+        _, status = os.waitpid(pid, 0)
+        handler.close()
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+
+class BenchmarkGateTest(unittest.TestCase):
+    def test_compare_with_baseline(self):
+        baseline = {"book_get": {"statements": 1, "time_ms": 2.0}}
+        self.assertEqual(
+            compare({"book_get": {"statements": 1, "time_ms": 3.0}}, baseline), []
+        )
+        regressions = compare(
+            {"book_get": {"statements": 2, "time_ms": 9.0}}, baseline, tolerance=1.0
+        )
+        self.assertEqual(len(regressions), 2)
+        # Benchmarks without a baseline yet never fail
+        self.assertEqual(compare({"new": {"statements": 9, "time_ms": 1}}, {}), [])
+
+
+class LoadTestTest(unittest.TestCase):
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 11))
+        self.assertEqual(percentile(values, 0.5), 5)
+        self.assertEqual(percentile(values, 0.95), 10)
+        self.assertEqual(percentile(values, 0.1), 1)
+        self.assertEqual(percentile(list(range(1, 31)), 0.1), 3)
+        self.assertEqual(percentile([7], 0.99), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+
+class MigrationTest(unittest.TestCase):
+    def test_upgrade_adds_indexes_to_existing_schema(self):
+        engine = create_engine("sqlite://")
+        # Schema as db.create_all() left it before the indexes existed
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            for index in inspect(connection).get_indexes("books"):
+                connection.execute(text(f"DROP INDEX {index['name']}"))
+
+        versions = [version for version, _, _ in MIGRATIONS]
+        self.assertEqual(upgrade(engine), versions)
+        index_names = {
+            index["name"] for index in inspect(engine).get_indexes("books")
+        }
+        self.assertIn("ix_books_type_id_year", index_names)
+        self.assertIn("ix_books_author", index_names)
+        self.assertEqual(upgrade(engine), [])
+
+    def test_initialize_seeds_book_types_once(self):
+        engine = create_engine("sqlite://")
+        self.assertEqual(initialize(engine)[1], ["fiction", "non-fiction"])
+        self.assertEqual(initialize(engine), ([], []))
+        with engine.connect() as connection:
+            count = connection.execute(text("SELECT COUNT(*) FROM booktypes"))
+            self.assertEqual(count.scalar(), 2)
+
+    def test_create_app_does_not_touch_the_database(self):
+        with mock.patch.dict(os.environ, {"DATABASE_URL": "sqlite:////tmp/none.db"}):
+            new_app = create_app()
+        with new_app.app_context():
+            pool = db.engine.pool
+            self.assertEqual(pool.checkedin() + pool.checkedout(), 0)
+        self.assertFalse(os.path.exists("/tmp/none.db"))
+
 
 class BookCollectionApiTest(unittest.TestCase):
     def setUp(self):
@@ -178,6 +1109,246 @@ class BookCollectionApiTest(unittest.TestCase):
         response = self.app.delete(f"/books/collections/{collection_id}")
         self.assertEqual(response.status_code, 200)
 
+    def test_search_collections(self):
+        collection_data = {
+            "name": "Thesis sources",
+            "description": "Everything about photosynthesis",
+            "book_ids": [],
+        }
+        collection_id = self.app.post(
+            "/books/collections", json=collection_data
+        ).json["collection_id"]
+
+        response = self.app.get('/books/collections?q=photosynthesis "thesis')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [collection["id"] for collection in response.json["collections"]],
+            [collection_id],
+        )
+
+        self.app.delete(f"/books/collections/{collection_id}")
+
+    def test_get_collections_with_cursor(self):
+        collection_data = {
+            "name": "Cursor Collection",
+            "description": "Paged by cursor",
+            "book_ids": [],
+        }
+        ids = [
+            self.app.post("/books/collections", json=collection_data).json[
+                "collection_id"
+            ]
+            for _ in range(3)
+        ]
+
+        response = self.app.get("/books/collections?name=Cursor Collection&limit=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json["collections"]), 2)
+        self.assertNotIn("total", response.json)
+        response = self.app.get(
+            "/books/collections?name=Cursor Collection&limit=2"
+            f"&after={response.json['next_cursor']}"
+        )
+        self.assertEqual(
+            [collection["id"] for collection in response.json["collections"]],
+            ids[2:],
+        )
+        self.assertIsNone(response.json["next_cursor"])
+
+        for collection_id in ids:
+            self.app.delete(f"/books/collections/{collection_id}")
+
+    def test_get_collection_not_modified(self):
+        book_id = self.app.post(
+            "/books/books",
+            json={
+                "title": "Member",
+                "author": "Author",
+                "type": "fiction",
+                "year": 2000,
+            },
+        ).json["id"]
+        collection_data = {
+            "name": "Etag Collection",
+            "description": "Etag",
+            "book_ids": [],
+        }
+        collection_id = self.app.post(
+            "/books/collections", json=collection_data
+        ).json["collection_id"]
+        url = f"/books/collections/{collection_id}"
+
+        etag = self.app.get(url).headers["ETag"]
+        with count_queries() as statements:
+            response = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(statements), 1)
+
+        # Changing only the membership changes the ETag too
+        self.app.put(url, json={**collection_data, "book_ids": [book_id]})
+        response = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["book_ids"], [book_id])
+
+        self.app.delete(url)
+        self.app.delete(f"/books/books/{book_id}")
+
+    def test_list_collections_query_count(self):
+        book_id = self.app.post(
+            "/books/books",
+            json={
+                "title": "Member",
+                "author": "Author",
+                "type": "fiction",
+                "year": 2000,
+            },
+        ).json["id"]
+        collection_data = {
+            "name": "Counted Collection",
+            "description": "Query count",
+            "book_ids": [book_id],
+        }
+        url = "/books/collections?name=Counted Collection&per_page=50"
+
+        ids = [
+            self.app.post("/books/collections", json=collection_data).json[
+                "collection_id"
+            ]
+        ]
+        with count_queries() as statements:
+            response = self.app.get(url)
+        single = len(statements)
+
+        for _ in range(5):
+            ids.append(
+                self.app.post("/books/collections", json=collection_data).json[
+                    "collection_id"
+                ]
+            )
+        with count_queries() as statements:
+            response = self.app.get(url)
+        self.assertEqual(len(statements), single)
+        self.assertEqual(len(response.json["collections"]), 6)
+        for collection in response.json["collections"]:
+            self.assertEqual(collection["book_ids"], [book_id])
+
+        with count_queries() as statements:
+            response = self.app.get(f"/books/collections/{ids[0]}")
+        self.assertEqual(response.json["book_ids"], [book_id])
+        self.assertEqual(len(statements), 2)
+
+        for collection_id in ids:
+            self.app.delete(f"/books/collections/{collection_id}")
+        self.app.delete(f"/books/books/{book_id}")
+
+    def test_patch_collection_membership(self):
+        book = {"title": "Member", "author": "Author", "type": "fiction", "year": 2000}
+        book_ids = [
+            self.app.post("/books/books", json=book).json["id"] for _ in range(3)
+        ]
+        collection_id = self.app.post(
+            "/books/collections",
+            json={"name": "Delta", "description": "Delta", "book_ids": book_ids[:2]},
+        ).json["collection_id"]
+        url = f"/books/collections/{collection_id}"
+        etag = self.app.get(url).headers["ETag"]
+
+        response = self.app.patch(
+            url, json={"add": [book_ids[1], book_ids[2]], "remove": [book_ids[0]]}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["added"], 1)
+        self.assertEqual(response.json["removed"], 1)
+        response = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["book_ids"], book_ids[1:])
+
+        response = self.app.patch(url, json={"add": [book_ids[0], 99999]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["book_ids"], [99999])
+        self.assertEqual(self.app.get(url).json["book_ids"], book_ids[1:])
+
+        response = self.app.patch("/books/collections/99999", json={"add": []})
+        self.assertEqual(response.status_code, 404)
+
+        self.app.delete(url)
+        for book_id in book_ids:
+            self.app.delete(f"/books/books/{book_id}")
+
+    def test_get_collection_expanded(self):
+        book = {"title": "Inline", "author": "Author", "type": "fiction", "year": 2000}
+        book_id = self.app.post("/books/books", json=book).json["id"]
+        collection_id = self.app.post(
+            "/books/collections",
+            json={"name": "Expand", "description": "Expand", "book_ids": [book_id]},
+        ).json["collection_id"]
+        url = f"/books/collections/{collection_id}?expand=books"
+
+        with count_queries() as statements:
+            response = self.app.get(url)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(response.json["books"][0]["title"], "Inline")
+        etag = response.headers["ETag"]
+
+        # Editing a member book changes the expanded representation
+        self.app.put(f"/books/books/{book_id}", json={**book, "title": "Edited"})
+        response = self.app.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["books"][0]["title"], "Edited")
+
+        self.app.delete(f"/books/collections/{collection_id}")
+        self.app.delete(f"/books/books/{book_id}")
+
+    def test_stats_follow_writes(self):
+        def counts():
+            stats = self.app.get("/books/stats?top=1000").json
+            return (
+                {row["year"]: row["count"] for row in stats["by_year"]}.get(1234, 0),
+                {row["author"]: row["count"] for row in stats["by_author"]},
+                stats["books"],
+            )
+
+        year, authors, total = counts()
+        book = {"title": "Stat", "author": "Stat Author", "type": "fiction"}
+        book["year"] = 1234
+        book_id = self.app.post("/books/books", json=book).json["id"]
+        self.app.post(
+            "/books/books/import",
+            data=json.dumps({**book, "author": "Stat Importer"}),
+            content_type="application/x-ndjson",
+        )
+        self.assertEqual(counts()[0], year + 2)
+        self.assertEqual(counts()[1]["Stat Author"], 1)
+        self.assertEqual(counts()[2], total + 2)
+
+        self.app.put(f"/books/books/{book_id}", json={**book, "year": 1235})
+        collection_id = self.app.post(
+            "/books/collections",
+            json={"name": "Stats", "description": "Stats", "book_ids": [book_id]},
+        ).json["collection_id"]
+        stats = self.app.get("/books/stats?top=1000").json
+        self.assertIn(
+            {"collection_id": collection_id, "name": "Stats", "count": 1},
+            stats["by_collection"],
+        )
+        self.assertEqual(counts()[0], year + 1)
+
+        imported = self.app.get("/books/books?author=Stat Importer").json["books"]
+        self.app.delete(f"/books/collections/{collection_id}")
+        self.app.delete(f"/books/books/{book_id}")
+        self.app.delete(f"/books/books/{imported[0]['id']}")
+        self.assertEqual(counts(), (year, authors, total))
+
+        # The summary tables agree with counting the books themselves
+        with app.app_context():
+            exact = dict(
+                db.session.execute(
+                    text("SELECT year, COUNT(*) FROM books GROUP BY year")
+                ).all()
+            )
+        stats = self.app.get("/books/stats").json
+        self.assertEqual({row["year"]: row["count"] for row in stats["by_year"]}, exact)
+
     def test_delete_nonexistent_collection(self):
         response = self.app.delete("/books/collections/99999")
         self.assertEqual(response.status_code, 404)
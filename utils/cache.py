@@ -0,0 +1,267 @@
+# cache.py
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from db.booktypes import booktypes
+from db.models import Book
+from utils.metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    In-process LRU cache of strings bounded by entry count, total size in
+    bytes and a per-entry time to live.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024, ttl=30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def _drop(self, key):
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None or entry[1] < now:
+                    if entry is not None:
+                        self._drop(key)
+                    values.append(None)
+                    continue
+                self._entries.move_to_end(key)
+                values.append(entry[0])
+        return values
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._bytes += len(value)
+            while (
+                len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._bytes = 0
+
+
+class SharedCache:
+    """
+    Cache kept in a Redis-compatible server so every worker shares it.
+    `client` only needs get, mget and set(key, value, ex=seconds).
+    """
+
+    def __init__(self, client, ttl=30):
+        self.client = client
+        self.ttl = ttl
+        # Evictions happen inside the server and aren't visible from here
+        self.evictions = 0
+
+    def get_many(self, keys):
+        return [
+            value.decode() if isinstance(value, bytes) else value
+            for value in self.client.mget(keys)
+        ]
+
+    def set(self, key, value):
+        self.client.set(key, value, ex=self.ttl)
+
+
+def cache_from_env():
+    """
+    Build the cache backend from RESULT_CACHE_* environment variables.
+    RESULT_CACHE_URL selects a shared Redis cache, the redis package is only
+    needed then. Without it (or if it can't be used) the cache is local, and
+    with several worker processes a write made in one of them only reaches
+    the others' caches after RESULT_CACHE_TTL seconds.
+    """
+    ttl = int(os.getenv("RESULT_CACHE_TTL", "30"))
+    url = os.getenv("RESULT_CACHE_URL")
+    if url:
+        try:
+            import redis
+
+            return SharedCache(redis.Redis.from_url(url), ttl=ttl)
+        except ImportError:
+            logger.warning("redis is not installed, using the local result cache")
+    return LocalCache(
+        max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024")),
+        max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+        ttl=ttl,
+    )
+
+
+# Equality filters of the book search, in the order they are keyed
+BOOK_FILTERS = ["author", "title", "year", "book_type"]
+
+
+def _normalize(name, value):
+    # "year=02020" finds the same books as "year=2020"
+    if name == "year" and value.isdigit():
+        return str(int(value))
+    return value
+
+
+class BookSearchCache:
+    """
+    Cache of book search responses keyed by the query string.
+
+    Every entry depends on a generation token per equality filter it uses,
+    for example "author=Kim", or on the "all" token if it uses none. Writing
+    a book replaces the tokens of its old and new field values and "all", so
+    only searches the book could appear in are invalidated.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _generations(self, names):
+        keys = [f"gen:{name}" for name in names]
+        tokens = self.backend.get_many(keys)
+        for i, token in enumerate(tokens):
+            if token is None:
+                # A missing token (new or evicted) can never match an old entry
+                tokens[i] = uuid.uuid4().hex
+                self.backend.set(keys[i], tokens[i])
+        return tokens
+
+    def key(self, params):
+        names = [
+            f"{name}={_normalize(name, params[name])}"
+            for name in BOOK_FILTERS
+            if name in params
+        ] or ["all"]
+        signature = json.dumps(
+            [sorted(params.items(multi=True)), self._generations(names)]
+        )
+        return "books:" + hashlib.sha1(signature.encode()).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get_many([key])[0]
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, body, status):
+        self.backend.set(key, json.dumps([body, status]))
+
+    def invalidate(self, books):
+        """`books` are dicts of author, title, year and book_type values."""
+        names = {"all"}
+        for book in books:
+            for name in BOOK_FILTERS:
+                if book.get(name) is not None:
+                    names.add(f"{name}={book[name]}")
+        for name in names:
+            self.backend.set(f"gen:{name}", uuid.uuid4().hex)
+        self.invalidations += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+book_search_cache = BookSearchCache(cache_from_env())
+
+
+def _cache_metrics():
+    return [
+        (
+            f"book_search_cache_{name}_total",
+            "counter",
+            f"Book search cache {name}.",
+            value,
+        )
+        for name, value in book_search_cache.stats().items()
+    ]
+
+
+metrics.add_collector(_cache_metrics)
+
+
+def book_filter_values(title, author, year, type_id):
+    """The values a book matches the search filters with."""
+    return {
+        "author": author,
+        "title": title,
+        "year": _normalize("year", str(year)) if year is not None else None,
+        "book_type": booktypes.name_for(type_id),
+    }
+
+
+def _old_and_new_values(book):
+    state = inspect(book)
+    values = []
+    for pick in (lambda history: history.deleted, lambda history: history.added):
+        fields = {}
+        for name in ("title", "author", "year", "type_id"):
+            history = state.attrs[name].history
+            changed = pick(history)
+            fields[name] = changed[0] if changed else getattr(book, name)
+        values.append(book_filter_values(**fields))
+    return values
+
+
+@event.listens_for(Session, "before_flush")
+def _collect_book_writes(session, flush_context, instances):
+    pending = session.info.setdefault("book_cache_writes", [])
+    for book in session.new:
+        if isinstance(book, Book):
+            pending.append(
+                book_filter_values(book.title, book.author, book.year, book.type_id)
+            )
+    for book in list(session.dirty) + list(session.deleted):
+        if isinstance(book, Book):
+            pending.extend(_old_and_new_values(book))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    # Invalidating only once the write is visible keeps a concurrent reader
+    # from caching the old result again
+    pending = session.info.pop("book_cache_writes", None)
+    if pending:
+        book_search_cache.invalidate(pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_book_writes(session):
+    session.info.pop("book_cache_writes", None)
@@ -0,0 +1,30 @@
+# conditional.py
+
+import hashlib
+
+from flask import Response, request
+from werkzeug.http import quote_etag
+
+
+def make_etag(*parts):
+    """Build an ETag value from anything that identifies a representation."""
+    return hashlib.sha1(":".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def query_signature():
+    """The query string in a canonical order, for list ETags."""
+    return sorted(request.args.items(multi=True))
+
+
+def etag_headers(etag):
+    return {"ETag": quote_etag(etag, weak=True)}
+
+
+def not_modified(etag):
+    """
+    Return a 304 response if the client already has `etag`, otherwise None.
+    Resources call this before loading or serializing anything else.
+    """
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=etag_headers(etag))
+    return None
@@ -0,0 +1,225 @@
+# metrics.py
+
+import os
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class RouteStats:
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.requests = 0
+        self.latency = 0.0
+        self.statements = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.pool_wait = 0.0
+
+
+class Metrics:
+    """
+    Per route and method request/SQL statistics kept in process memory and
+    rendered in the Prometheus text exposition format.
+
+    Every worker process keeps its own, so a scrape only sees the worker that
+    served it. Samples carry the process id as a worker label, which keeps
+    the values of different workers (and of a recycled worker) in separate
+    series; sum them by route and method in queries.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._collectors = []
+
+    def add_collector(self, collect):
+        """
+        Add process-wide values to the output. `collect` returns a list of
+        (name, type, help text, value) tuples.
+        """
+        self._collectors.append(collect)
+
+    def observe(self, route, method, latency, usage):
+        with self._lock:
+            stats = self._routes.setdefault((route, method), RouteStats())
+            stats.requests += 1
+            stats.latency += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.bucket_counts[i] += 1
+            stats.statements += usage["statements"]
+            stats.sql_time += usage["sql_time"]
+            stats.rows += usage["rows"]
+            stats.pool_wait += usage["pool_wait"]
+
+    def reset(self):
+        with self._lock:
+            self._routes = {}
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+
+        with self._lock:
+            routes = sorted(self._routes.items())
+        worker = os.getpid()
+
+        def labels(route, method, **extra):
+            pairs = [("route", route), ("method", method), ("worker", worker)]
+            pairs += list(extra.items())
+            return ",".join(f'{key}="{value}"' for key, value in pairs)
+
+        histogram = []
+        for (route, method), stats in routes:
+            for bound, count in zip(LATENCY_BUCKETS, stats.bucket_counts):
+                histogram.append(
+                    "http_request_duration_seconds_bucket"
+                    f"{{{labels(route, method, le=bound)}}} {count}"
+                )
+            histogram.append(
+                "http_request_duration_seconds_bucket"
+                f'{{{labels(route, method, le="+Inf")}}} {stats.requests}'
+            )
+            histogram.append(
+                "http_request_duration_seconds_sum"
+                f"{{{labels(route, method)}}} {stats.latency}"
+            )
+            histogram.append(
+                "http_request_duration_seconds_count"
+                f"{{{labels(route, method)}}} {stats.requests}"
+            )
+        family(
+            "http_request_duration_seconds",
+            "histogram",
+            "Request latency.",
+            histogram,
+        )
+
+        counters = [
+            ("db_statements_total", "statements", "SQL statements executed."),
+            (
+                "db_statement_duration_seconds_total",
+                "sql_time",
+                "Time spent executing SQL statements.",
+            ),
+            (
+                "db_rows_total",
+                "rows",
+                "Rows returned or affected, as reported by the DB driver.",
+            ),
+            (
+                "db_pool_checkout_wait_seconds_total",
+                "pool_wait",
+                "Time spent waiting for a connection from the pool.",
+            ),
+        ]
+        for name, attribute, help_text in counters:
+            family(
+                name,
+                "counter",
+                help_text,
+                [
+                    f"{name}{{{labels(route, method)}}} {getattr(stats, attribute)}"
+                    for (route, method), stats in routes
+                ],
+            )
+
+        for collect in self._collectors:
+            for name, kind, help_text, value in collect():
+                family(name, kind, help_text, [f'{name}{{worker="{worker}"}} {value}'])
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def request_usage():
+    """SQL usage of the current request, created on first use."""
+    if "db_usage" not in g:
+        g.db_usage = {"statements": 0, "sql_time": 0.0, "rows": 0, "pool_wait": 0.0}
+    return g.db_usage
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if not has_request_context():
+        return
+    usage = request_usage()
+    usage["statements"] += 1
+    usage["sql_time"] += elapsed
+    if cursor.rowcount > 0:
+        usage["rows"] += cursor.rowcount
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _before_session_execute(orm_execute_state):
+    if has_request_context():
+        g.db_checkout_start = time.perf_counter()
+
+
+@event.listens_for(Session, "after_begin")
+def _after_session_begin(session, transaction, connection):
+    # A session connects lazily on its first statement, the time between that
+    # statement being issued and the transaction starting is the pool wait
+    if has_request_context() and "db_checkout_start" in g:
+        start = g.pop("db_checkout_start")
+        request_usage()["pool_wait"] += time.perf_counter() - start
+
+
+def init_metrics(app):
+    """
+    Record every request of `app` and serve the results on /metrics.
+    Set SERVER_TIMING=1 to also send per-request Server-Timing headers.
+    """
+    server_timing = os.getenv("SERVER_TIMING", "0") == "1"
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        if "request_start" not in g:
+            return response
+        latency = time.perf_counter() - g.request_start
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        usage = request_usage()
+        if route != "/metrics":
+            metrics.observe(route, request.method, latency, usage)
+        if server_timing:
+            response.headers["Server-Timing"] = (
+                f"db;dur={usage['sql_time'] * 1000:.2f};"
+                f'desc="{usage["statements"]} queries", '
+                f"total;dur={latency * 1000:.2f}"
+            )
+        return response
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,153 @@
+# pagination.py
+
+import base64
+import binascii
+import json
+import math
+import os
+
+from utils.cache import LocalCache
+
+
+MAX_CURSOR_LIMIT = 100
+MAX_PER_PAGE = 100
+
+# How `total` and `pages` of a numbered page are computed:
+#   exact: COUNT(*) of the filtered rows on every request
+#   cached: COUNT(*) remembered per filter set for TOTAL_CACHE_TTL seconds
+#   estimated: the planner's row estimate, Postgres only
+#   none: not computed, total and pages are null
+TOTAL_MODES = ["exact", "cached", "estimated", "none"]
+
+total_cache = LocalCache(
+    max_entries=int(os.getenv("TOTAL_CACHE_MAX_ENTRIES", "4096")),
+    ttl=int(os.getenv("TOTAL_CACHE_TTL", "10")),
+)
+
+
+def encode_cursor(last_id):
+    """Turn the id of the last row on a page into an opaque cursor string."""
+    raw = json.dumps({"id": last_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the id stored in a cursor, or None if the cursor is malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        last_id = data["id"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(last_id, int) or isinstance(last_id, bool) or last_id < 0:
+        return None
+    return last_id
+
+
+def keyset_page(query, key_column, after, limit):
+    """
+    Fetch one page of `query` ordered by `key_column`, starting after the row
+    the `after` cursor points to. No OFFSET and no COUNT(*) are issued.
+
+    Returns (items, next_cursor, error). `error` is a message for a 400
+    response when the cursor or the limit is invalid.
+    """
+    if limit is None or limit < 1 or limit > MAX_CURSOR_LIMIT:
+        return None, None, f"Limit must be between 1 and {MAX_CURSOR_LIMIT}"
+
+    if after:
+        last_id = decode_cursor(after)
+        if last_id is None:
+            return None, None, "Invalid cursor"
+        query = query.filter(key_column > last_id)
+
+    # One extra row tells us whether another page exists
+    items = query.order_by(key_column).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].id)
+    return items, next_cursor, None
+
+
+def default_total_mode():
+    """The total mode of requests that don't pass one, from PAGINATION_TOTAL."""
+    mode = os.getenv("PAGINATION_TOTAL", "exact")
+    return mode if mode in TOTAL_MODES else "exact"
+
+
+def estimated_count(query):
+    """
+    The number of rows the Postgres planner expects `query` to return, from
+    the table statistics (reltuples and the column histograms), or None on
+    other databases or if the table was never analyzed.
+    """
+    session = query.session
+    if session.get_bind().dialect.name != "postgresql":
+        return None
+    # Without statistics the planner guesses from the table size on disk
+    table = query.column_descriptions[0]["entity"].__tablename__
+    analyzed = session.connection().exec_driver_sql(
+        "SELECT reltuples > 0 FROM pg_class WHERE oid = %(table)s::regclass",
+        {"table": table},
+    )
+    if not analyzed.scalar():
+        return None
+    compiled = query.order_by(None).statement.compile(
+        dialect=session.get_bind().dialect
+    )
+    plan = (
+        session.connection()
+        .exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params)
+        .scalar()
+    )
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def count_total(query, mode, signature):
+    """
+    Count the rows of `query` in total mode `mode`; `signature` identifies
+    its filters for the cached mode. Returns (total, mode used), modes that
+    can't be used here fall back to "exact".
+    """
+    if mode == "none":
+        return None, mode
+    if mode == "estimated":
+        total = estimated_count(query)
+        if total is not None:
+            return total, mode
+        mode = "exact"
+    if mode == "cached":
+        key = "total:" + json.dumps(signature, sort_keys=True)
+        cached = total_cache.get_many([key])[0]
+        if cached is not None:
+            return int(cached), mode
+        total = query.order_by(None).count()
+        total_cache.set(key, str(total))
+        return total, mode
+    return query.order_by(None).count(), "exact"
+
+
+def offset_page(query, page, per_page, mode, signature):
+    """
+    Fetch page number `page` of `query` and count its total rows according
+    to the total mode `mode` (see TOTAL_MODES).
+
+    Returns (items, pagination, error) where pagination holds total, pages,
+    page and the total_mode actually used. `error` is a message for a 400
+    response when the page or the page size is invalid.
+    """
+    if page is None or page < 1:
+        return None, None, "Page must be at least 1"
+    if per_page is None or per_page < 1 or per_page > MAX_PER_PAGE:
+        return None, None, f"Per page must be between 1 and {MAX_PER_PAGE}"
+
+    items = query.paginate(
+        page=page, per_page=per_page, error_out=False, count=False
+    ).items
+    total, mode = count_total(query, mode, signature)
+    pages = None if total is None else math.ceil(total / per_page)
+    pagination = {"total": total, "pages": pages, "page": page, "total_mode": mode}
+    return items, pagination, None
@@ -0,0 +1,220 @@
+# request_log.py
+
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request
+
+from utils.metrics import request_usage
+
+
+# Loggers whose records end up in the log file, besides the app's own
+LOGGERS = ["flask_restx", "db", "utils"]
+
+# Standard LogRecord attributes, everything else was passed with `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the message, level and any extra fields."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    """Add the method and route of the current request to every record."""
+
+    def filter(self, record):
+        if has_request_context():
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule else None
+        return True
+
+
+def file_handler():
+    """
+    The handler that writes the log, from LOG_* environment variables.
+
+    LOG_FILE: path, "-" for stdout; "{pid}" is replaced by the process id,
+        so every worker can rotate its own file
+    LOG_MAX_BYTES, LOG_BACKUP_COUNT: rotate by size (default 10 MB, 5 files)
+    LOG_ROTATE_WHEN: rotate by time instead, e.g. "midnight" or "H"
+    """
+    path = os.getenv("LOG_FILE", "app.log").format(pid=os.getpid())
+    backups = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+    if path == "-":
+        handler = logging.StreamHandler()
+    elif os.getenv("LOG_ROTATE_WHEN"):
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=os.getenv("LOG_ROTATE_WHEN"), backupCount=backups
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            path,
+            maxBytes=int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+            backupCount=backups,
+        )
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+# Every AsyncLogHandler, so a forked child can reset their locks
+_async_handlers = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    # Another thread of the parent may have held the lock at the fork, the
+    # child would then wait for it forever
+    for handler in _async_handlers:
+        handler._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a queue; a background thread formats and writes them,
+    so request threads never wait for file I/O.
+
+    The thread and the file are created on first use in every process, a
+    worker forked from a preloaded app starts its own.
+    """
+
+    def __init__(self, make_handler=file_handler):
+        super().__init__(queue.SimpleQueue())
+        self.make_handler = make_handler
+        self.listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+        _async_handlers.add(self)
+        self.addFilter(RequestContextFilter())
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # The queue inherited from the parent belongs to its listener
+            self.queue = queue.SimpleQueue()
+            self.listener = logging.handlers.QueueListener(
+                self.queue, self.make_handler()
+            )
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Like QueueHandler.prepare, but the message stays just the message
+        # and the traceback is kept as text for the JSON "exception" field
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        super().enqueue(record)
+
+    def flush(self):
+        """Write out everything queued so far."""
+        with self._lock:
+            if self.listener is not None and self._pid == os.getpid():
+                self.listener.stop()
+                self.listener.start()
+
+    def close(self):
+        with self._lock:
+            if self.listener is not None and self._pid == os.getpid():
+                self.listener.stop()
+                for handler in self.listener.handlers:
+                    handler.close()
+            self.listener = None
+            self._pid = None
+        super().close()
+
+
+_handler = None
+
+
+def init_logging(app):
+    """
+    Log every request of `app` as a structured record and send all app log
+    records through an AsyncLogHandler.
+
+    LOG_LEVEL: level of the app loggers (default INFO)
+    LOG_SAMPLE_RATE: share of successful requests that are logged (default
+        1); errors and requests slower than LOG_SLOW_MS are always logged
+    """
+    global _handler
+    # Every app of the process shares one handler (and one writer thread)
+    if _handler is None:
+        _handler = AsyncLogHandler()
+    handler = _handler
+    level = os.getenv("LOG_LEVEL", "INFO")
+    sample_rate = float(os.getenv("LOG_SAMPLE_RATE", "1"))
+    slow = float(os.getenv("LOG_SLOW_MS", "1000")) / 1000
+
+    requests_logger = app.logger.getChild("requests")
+    loggers = [app.logger, requests_logger]
+    for logger in loggers + [logging.getLogger(name) for name in LOGGERS]:
+        logger.setLevel(level)
+        if handler not in logger.handlers:
+            logger.addHandler(handler)
+    # Not through app.logger, its default handler writes to stderr
+    requests_logger.propagate = False
+    app.extensions["request_log"] = handler
+
+    @app.before_request
+    def start_timer():
+        g.setdefault("request_start", time.perf_counter())
+
+    @app.after_request
+    def log_request(response):
+        if "request_start" not in g:
+            return response
+        latency = time.perf_counter() - g.request_start
+        if (
+            response.status_code < 400
+            and latency < slow
+            and random.random() >= sample_rate
+        ):
+            return response
+        usage = request_usage()
+        requests_logger.info(
+            "request",
+            extra={
+                "path": request.path,
+                "status": response.status_code,
+                "latency_ms": round(latency * 1000, 3),
+                "queries": usage["statements"],
+                "sql_ms": round(usage["sql_time"] * 1000, 3),
+            },
+        )
+        return response
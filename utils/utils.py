@@ -1,11 +1,44 @@
 # utils.py
 
+from db.booktypes import booktypes
+
 
 def is_integer(s):
+    # int() would silently cut 12.5 to 12
+    if isinstance(s, float) and not s.is_integer():
+        return False
     try:
         int(s)
         if int(s) < 0:
             return False
         return True
-    except ValueError:
+    except (TypeError, ValueError):
         return False
+
+
+def validate_book(data):
+    """
+    Check a book payload the same way for every write path.
+    Returns an error message, or None if the payload is valid.
+    """
+    if "title" not in data:
+        return 'Missing "title" field in JSON data'
+    if not isinstance(data["title"], str):
+        return 'Field "title" must be a string'
+    if "author" not in data:
+        return 'Missing "author" field in JSON data'
+    if not isinstance(data["author"], str):
+        return 'Field "author" must be a string'
+    if "type" not in data:
+        return 'Missing "type" field in JSON data'
+    if not isinstance(data["type"], str):
+        return 'Field "type" must be a string'
+    if booktypes.id_for(data["type"]) is None:
+        return booktypes.invalid_type_message()
+    if "year" not in data:
+        return 'Missing "year" field in JSON data'
+    if not is_integer(data["year"]):
+        return "Year is not an integer"
+    if len(str(data["year"])) > 4:
+        return "Year is too long"
+    return None